@@ -1,2 +1,15 @@
-from .bot import *
-from .twitter_bot import *
\ No newline at end of file
+#The bot classes are only imported when they are first used, so that importing OpenMediaBot (or running it from the command line) doesn't import Twython, PyDrive2 and Pillow until they are needed.
+_EXPORTS = {"Bot":".bot", "Media":".bot", "TwitterBot":".twitter_bot"}
+
+__all__ = list(_EXPORTS)
+
+def __getattr__(name):
+
+    if name not in _EXPORTS:
+        raise AttributeError("module '{}' has no attribute '{}'".format(__name__, name))
+
+    from importlib import import_module
+
+    value = globals()[name] = getattr(import_module(_EXPORTS[name], __name__), name)
+
+    return value
@@ -0,0 +1,6 @@
+#This allows bots to be run with "python -m OpenMediaBot config.json post".
+import sys
+
+from .cli import main
+
+sys.exit(main())
@@ -2,8 +2,73 @@ import sqlite3
 
 import logging
 
+import json
+
 import re
 
+import threading
+
+#These statements build each bot's table in the database, each one upgrades the table by one version.
+#The version that a table is at is stored in the bot's state, so that existing databases are upgraded automatically.
+#New statements must only ever be added to the end of this list.
+_MIGRATIONS = [
+    """CREATE TABLE IF NOT EXISTS '{0}' (
+    ID text PRIMARY KEY,
+    NAME text NOT NULL,
+    LOCATION text NOT NULL,
+    POSTED BOOLEAN NOT NULL);""",
+
+    #This index allows us to count and pick unposted files without reading the whole table.
+    "CREATE INDEX IF NOT EXISTS '{0}_POSTED' ON '{0}' (POSTED);",
+
+    #The version of a file changes whenever its content does. For Drive files, this is the MD5 checksum or modification date.
+    "ALTER TABLE '{0}' ADD COLUMN VERSION text;",
+
+    #The size in bytes, modification time, and MIME type of each file.
+    "ALTER TABLE '{0}' ADD COLUMN SIZE integer;",
+    "ALTER TABLE '{0}' ADD COLUMN MTIME real;",
+    "ALTER TABLE '{0}' ADD COLUMN MIMETYPE text;",
+
+    #This table stores the modification time of every local folder we scanned, so that unchanged folders don't have to be listed again.
+    """CREATE TABLE IF NOT EXISTS '{0}_DIRS' (
+    PATH text PRIMARY KEY,
+    MTIME integer NOT NULL);""",
+
+    #The exact (MD5) and perceptual hashes of each file, and the ID of the file it is a duplicate of, if it is one.
+    "ALTER TABLE '{0}' ADD COLUMN HASH text;",
+    "ALTER TABLE '{0}' ADD COLUMN PHASH text;",
+    "ALTER TABLE '{0}' ADD COLUMN GRP text;",
+
+    #These indexes allow us to pick from files that aren't duplicates without reading the whole table, and to find the duplicates of a file.
+    "CREATE INDEX IF NOT EXISTS '{0}_PICK' ON '{0}' (POSTED, GRP);",
+    "CREATE INDEX IF NOT EXISTS '{0}_GRP' ON '{0}' (GRP);",
+
+    #The folder each file was found in (one of "drive_folders" or "local_folders"), its priority, and when it was last posted, which are used by selection strategies.
+    "ALTER TABLE '{0}' ADD COLUMN FOLDER text;",
+    "ALTER TABLE '{0}' ADD COLUMN PRIORITY real;",
+    "ALTER TABLE '{0}' ADD COLUMN LAST_POSTED real;",
+
+    #Forgetting the Drive changes token makes the next update scan every Drive folder, which fills in the folder of files we already have.
+    "DELETE FROM OMB_STATE WHERE BOT='{0}' AND KEY='drive_token';",
+
+    #The hashes that the groups of duplicates were worked out from, and the bands of their perceptual hashes, which allow duplicates of new files to be found without reading the whole library. See dedup.py.
+    "CREATE TABLE IF NOT EXISTS '{0}_HASHES' (ID text PRIMARY KEY, HASH text, PHASH text);",
+    "CREATE INDEX IF NOT EXISTS '{0}_HASHES_HASH' ON '{0}_HASHES' (HASH);",
+    "CREATE TABLE IF NOT EXISTS '{0}_BANDS' (BAND integer NOT NULL, BITS integer NOT NULL, ID text NOT NULL, PRIMARY KEY (BAND, BITS, ID)) WITHOUT ROWID;",
+
+    #Forgetting the distance the groups were worked out with makes the next update group every file again, which fills in the hashes above.
+    "DELETE FROM OMB_STATE WHERE BOT='{0}' AND KEY='dedup_distance';"
+]
+
+#This function returns a string that changes whenever the content of a Drive file does.
+def _drive_version(file):
+    return file.get('md5Checksum') or file.get('modifiedDate')
+
+#This function returns the row we store in the database for a Drive file, given the folder it was found in.
+def _drive_row(file, folder):
+    return {"NAME":file['title'], "LOCATION":"DRIVE", "VERSION":_drive_version(file),
+            "SIZE":int(file['fileSize']) if file.get('fileSize') else None, "MTIME":None, "MIMETYPE":file.get('mimeType'), "HASH":file.get('md5Checksum'), "FOLDER":folder}
+
 #This class is used to store data associated with a piece of media.
 class Media:
     def __init__(self, data, mimetype, name, id):
@@ -16,11 +81,15 @@ class Media:
 #This is a base class that any bot will inherit from. Contains functions for downloading from drive, and interacting with that database.
 class Bot:
 
+    #These attributes are clients for other services, which are only created when they are first used, by the method named here.
+    #This means a bot that doesn't need Google Drive for a run (for example, if it posts a local file and doesn't update its database) never connects to it.
+    _clients = {"drive":"_connect_drive", "drive_client":"_connect_drive"}
+
     #Within this init function, we connect to various APIs and set user defined variables for the methods.
     def __init__(self, configfile = None,  **kwargs):
 
         #These are the default values for our Bot.
-        defaults = {"name":"OpenMediaBot","db":"media.db","gdrive_settings":"settings.yaml"}
+        defaults = {"name":"OpenMediaBot","db":"media.db","gdrive_settings":"settings.yaml","incremental_sync":False,"spool_size":8388608,"cache_dir":None,"cache_size":1073741824,"prefetch":False,"staging_dir":"staging","index_workers":8,"dedup":False,"dedup_distance":4,"dedup_workers":None,"selection":None,"selection_options":{},"new_priority":None,"instrument":False,"metrics_textfile":None,"metrics_hooks":(),"sync_max_age":0,"drive_workers":4,"drive_recursive":False}
         
         #Update the attributes defaults dictionary with any kwargs provided by the user.
         #Since a dictionary does not allow duplicate keys, kwargs provided by the user that were previously set in the default dict will override thier default values.
@@ -32,9 +101,7 @@ class Bot:
         if configfile is not None:
             
             with open(configfile) as jsonfile:
-                
-                import json
-                
+
                 self.__dict__.update(json.load(jsonfile))
 
         #We use the bot name as the name for our SQL table, this allows us to house multiple bots in the same databse file.
@@ -66,131 +133,610 @@ class Bot:
 
             self.logger.addHandler(file_handler)
 
-        #If Google Drive folders are provided, create an autheticated PyDrive object.
-        if self.__dict__.get("drive_folders") is not None:
+        #Clients are created on first use, and this makes sure only one thread creates each of them.
+        self._connecting = threading.Lock()
+
+        #A Drive client can be passed to us (a fake Drive, for example), otherwise one is created when it is first used.
+        if self.__dict__.get("drive_client") is None:
+            self.__dict__.pop("drive_client", None)
+
+        #Connect to our SQLite DB, unless we were given a connection to use.
+        if self.__dict__.get("connection") is None:
+            self.connection = sqlite3.connect(self.db)
+
+        #Create a cursor to execute commands within the database.
+        self.cursor = self.connection.cursor()
+
+        #This table stores small pieces of state for each bot, such as the Drive changes token.
+        self.cursor.execute("""CREATE TABLE IF NOT EXISTS OMB_STATE (
+        BOT text NOT NULL,
+        KEY text NOT NULL,
+        VALUE text,
+        PRIMARY KEY (BOT, KEY));""")
+
+        #Create our database table if it doesn't exist, or bring it up to date if it was made by an older version.
+        self._migrate()
+
+        #If a cache directory is provided, Drive media is kept on disk so it doesn't need to be downloaded again.
+        if self.cache_dir is not None:
+
+            from .cache import MediaCache
+
+            self.cache = MediaCache(self)
+
+        else:
+            self.cache = None
+
+        #If prefetching is enabled, the media for the next post is downloaded ahead of time.
+        if self.prefetch:
+
+            from .prefetch import Prefetcher
+
+            self.prefetcher = Prefetcher(self)
+
+        else:
+            self.prefetcher = None
+
+        #If instrumentation is enabled, the duration, bytes transferred, and outcome of each stage of the bot's work is recorded.
+        #Otherwise, the stages are still marked in the code, but nothing is recorded.
+        if self.instrument:
+
+            from .metrics import Metrics
+
+            self.metrics = Metrics(self, self.metrics_textfile, self.metrics_hooks)
+
+        else:
+
+            from .metrics import NullMetrics
+
+            self.metrics = NullMetrics()
+
+        #If a selection strategy is chosen, files are picked using their weights instead of all being equally likely.
+        if self.selection is not None:
+
+            from .selection import Selector, strategy
+
+            self.selector = Selector(self, strategy(self.selection, **self.selection_options))
+
+        else:
+            self.selector = None
+
+    #This function creates a client the first time it is used.
+    def __getattr__(self, name):
+
+        connect = type(self)._clients.get(name)
+
+        if connect is None:
+            raise AttributeError("'{}' object has no attribute '{}'".format(type(self).__name__, name))
+
+        with self._connecting:
+
+            #Another thread may have created the client while we were waiting.
+            if name not in self.__dict__:
+                getattr(self, connect)()
+
+        return self.__dict__[name]
+
+    #This function creates an autheticated PyDrive object, if Google Drive folders are provided and no Drive client was passed to us.
+    def _connect_drive(self):
+
+        self.drive = None
+        self.drive_client = self.__dict__.get("drive_client")
+
+        if self.drive_client is None and self.__dict__.get("drive_folders") is not None:
 
             self.logger.info("Connecting to Google Drive...")
-            
+
             #Used for Google Drive.
             from pydrive2.auth import GoogleAuth
             from pydrive2.drive import GoogleDrive
+            from .drive import PyDriveClient
 
             self.drive = GoogleDrive(GoogleAuth(settings_file=self.gdrive_settings))
 
-        #Connect to our SQLite DB.
-        self.connection = sqlite3.connect(self.db)
+            #All of our Drive calls go through a client, which allows a different client (such as a fake Drive) to be used instead.
+            self.drive_client = PyDriveClient(self.drive)
 
-        #Create a cursor to execute commands within the database.
-        self.cursor = self.connection.cursor()
+    #This function runs any of the statements in _MIGRATIONS that have not yet been run on the bot's table.
+    #The statements and the new version are run in one transaction, so a failed upgrade leaves the table as it was.
+    def _migrate(self):
+
+        if int(self._getstate("schema_version", 0)) < len(_MIGRATIONS):
+
+            with self.connection:
+
+                #Python's sqlite3 doesn't start a transaction for statements like ALTER TABLE, which would then each be committed on their own, so we start one ourselves.
+                #It takes the write lock straight away, so if two bots upgrade the same database at once, the second waits and then finds it has already been upgraded.
+                self.cursor.execute("BEGIN IMMEDIATE")
+
+                version = int(self._getstate("schema_version", 0))
+
+                for statement in _MIGRATIONS[version:]:
+                    self.cursor.execute(statement.format(self.name))
+
+                self._setstate("schema_version", len(_MIGRATIONS))
+
+    #This function makes the bot use a different database connection, such as one from a connection pool.
+    def _bind(self, connection):
+
+        self.connection = connection
+        self.cursor = connection.cursor()
+
+    #This function returns a value from the bot's state, or the default if it has not been set.
+    def _getstate(self, key, default=None):
+
+        self.cursor.execute("SELECT VALUE FROM OMB_STATE WHERE BOT=:BOT AND KEY=:KEY", {"BOT":self.name, "KEY":key})
+
+        row = self.cursor.fetchone()
+
+        return default if row is None else row[0]
+
+    #This function stores a value in the bot's state.
+    #It does not commit, so it can be made part of a larger transaction.
+    def _setstate(self, key, value):
+
+        self.cursor.execute("INSERT OR REPLACE INTO OMB_STATE VALUES (:BOT, :KEY, :VALUE)", {"BOT":self.name, "KEY":key, "VALUE":value})
 
     #This function updates and/or initializes our database.
-    def updatedb(self):
+    #If the last update was less than "sync_max_age" seconds ago, the update is skipped and None is returned, unless "force" is True.
+    def updatedb(self, force=False):
 
-        self.logger.info("Updating database...")
+        import time
 
-        #Create our database table if it doesn't exist.
-        self.cursor.execute("""CREATE TABLE IF NOT EXISTS '{}' (
-        ID text PRIMARY KEY,
-        NAME text NOT NULL,
-        LOCATION text NOT NULL,
-        POSTED BOOLEAN NOT NULL);""".format(self.name))
-       
-        #Query a list of IDs from the database.
-        self.cursor.execute("SELECT ID FROM '{}'".format(self.name))
+        with self.metrics.stage("updatedb") as stage:
 
-        #Get the result of the query.
-        db = [row[0] for row in self.cursor.fetchall()]
+            age = time.time() - float(self._getstate("last_sync", 0))
 
-        #Iterate through all the files in the Google Drive folder.
+            if not force and age < self.sync_max_age:
+                self.logger.info("Database was updated {} seconds ago, skipping update.".format(round(age)))
+                stage.outcome = "skipped"
+                changes = None
 
-        with self.connection:
+            else:
+                changes = self._updatedb()
 
-            #If we provide Google Drive folders, scan for changes.
-            if self.__dict__.get("drive_folders") is not None:
+                with self.connection:
+                    self._setstate("last_sync", time.time())
 
-                for folder_id in self.drive_folders:
+        self.metrics.flush()
 
-                    self.logger.info("Updating Drive folder {}...".format(folder_id))
+        return changes
 
-                    #Get a list of files in the folder.
-                    drive_files = self.drive.ListFile({'q': "'{}' in parents and trashed=false".format(folder_id)}).GetList()
+    #This function does the work of updatedb(), which times it.
+    def _updatedb(self):
 
-                    for file in drive_files:
+        self.logger.info("Updating database...")
 
-                        #If the file EXISTS in our database.
-                        if (file['id'] in db):
-                        
-                            #Make sure that the correct filename is reflected in our database.
-                            
-                            self.cursor.execute("SELECT NAME FROM '{}' WHERE ID=:ID".format(self.name),
-                            {"ID":file['id']})
+        #Query every file from the database at once, and store them in a dictionary so each lookup is constant time.
+        index = self._index()
 
-                            #The above query should only return one result, so we canuse fetchone.
-                            name = self.cursor.fetchone()[0]
+        #Every file we find in our folders that is new or may have changed is collected here, keyed by ID.
+        #Using a dictionary means we can compare our folders against the database in one pass, no matter how many files there are.
+        seen = {}
 
-                            #If the name has been changed, update our database.
-                            if file['title'] != name:
-                                self.cursor.execute("UPDATE '{}' SET NAME=:NAME WHERE ID=:ID".format(self.name),
-                                {"NAME":file['title'],"ID":file['id']})
-                                self.logger.info("RENAMED: {} TO {}".format(name, file['title']))
-                    
-                            #If the file exists in our database, remove it from the queried list.
-                            #By doing this, we will list of files that are in our database but not in the Google Drive folder.
-                            db.remove(file['id'])
-                        
-                        #If the file DOES NOT exist in our database, update the database with information for the new file.
-                        else:
+        #IDs of files we know haven't changed, IDs which we know have been deleted, and locations which were not fully scanned, so files missing from them should be kept.
+        unchanged = set()
+        deleted = set()
+        keep = set()
 
-                            self.cursor.execute("INSERT INTO '{}' VALUES (:ID, :NAME, 'DRIVE', 'POSTED'=False)".format(self.name),
-                            {"ID":file['id'], "NAME":file['title']})
+        #The Drive changes token, the Drive folders we listed, and local folder modification times we will save once our changes have been applied.
+        token = None
+        tree = None
+        folders = None
+
+        #If we provide Google Drive folders, scan for changes.
+        if self.__dict__.get("drive_folders") is not None:
 
-                            #Output some useful information for logging purposes.
-                            self.logger.info("ADDED: {} ({})".format(file['title'], file['id']))
-                            
-            #If we provide local folders, scan them for changes.
-            if self.__dict__.get("local_folders") is not None:
+            if self.incremental_sync:
 
-                import os
+                from .drive import InvalidTokenError
 
-                for folder in self.local_folders:
+                token = self._getstate("drive_token")
 
-                    for file in os.listdir(folder):
+                #A token is only valid for the folders it was created with, and if we were looking in their subfolders then too.
+                if token is not None and (self._getstate("drive_folders") != json.dumps(sorted(self.drive_folders)) or json.loads(self._getstate("drive_recursive", "false")) != self.drive_recursive):
+                    token = None
 
-                        #The itelligantly joins the folder path and the file name into a filepath. It will use the right structure based on the OS the bot is running on.
-                        id = os.path.join(folder,file)
+                if token is not None:
 
-                        #If the file exists in our database, remove it from the queried list.
-                        #By doing this, we will list of files that are in our database but not in the local folder.
-                        if id in db:
+                    self.logger.info("Fetching changes from Google Drive...")
 
-                            db.remove(id)
+                    try:
+                        changes, token = self.drive_client.list_changes(token)
+
+                    except InvalidTokenError:
+                        self.logger.info("Drive changes token is invalid, rescanning all Drive folders...")
+                        token = None
+
+                    else:
+
+                        #We only know about the Drive files that changed, so any that we did not see should be kept.
+                        if self._drive_changes(changes, seen, deleted):
+                            keep.add("DRIVE")
 
                         else:
+                            self.logger.info("Drive subfolders have changed, rescanning all Drive folders...")
+                            seen.clear()
+                            deleted.clear()
 
-                            #If the file is not in our database, we add it to the database
-                            #We use the file path as the ID for local files as the file path must be unique.
-                            self.cursor.execute("INSERT INTO '{}' VALUES (:ID, :NAME, 'LOCAL', 'POSTED'=False)".format(self.name),
-                            {"ID":id, "NAME":file})
+                #If we don't have a token, we get one before scanning so that no changes made during the scan are missed.
+                if token is None:
+                    token = self.drive_client.get_start_token()
 
-                            self.logger.info("ADDED: {} ({})".format(file, id))
+            if "DRIVE" not in keep:
+                tree = self._list_drive(seen)
 
-            #The remainder of the entires in the db array are files that exist in our database, but do not exist in any of the provided folders.
-            #We will remove these entries from our database.
-            for file in db:
+        #If we provide local folders, scan them for changes.
+        if self.__dict__.get("local_folders") is not None:
 
-                #Grab the name of the file we are about to delete, we want this for logging purposes.
-                self.cursor.execute("SELECT NAME FROM '{}' WHERE ID=:ID".format(self.name),
-                {"ID":file})
-                
-                name = self.cursor.fetchone()
+            from .local import LocalIndexer
 
-                self.cursor.execute("DELETE FROM '{}' WHERE ID=:ID".format(self.name),
-                {"ID":file})
-            
-                self.logger.info("DELETED: {} ({})".format(name, file))
+            self.logger.info("Updating local folders...")
+
+            found, known, folders = LocalIndexer(self).scan(index)
+
+            seen.update(found)
+            unchanged.update(known)
+
+        changes = self._reconcile(index, seen, unchanged, deleted, keep, token, folders, tree)
+
+        if self.dedup:
+            self._dedup(changes)
 
         self.logger.info("Database is up to date!")
 
+        return changes
+
+    #This function returns a dictionary of every file in the database, from its ID to a tuple of its name, location, version, MIME type and folder.
+    def _index(self):
+
+        self.cursor.execute("SELECT ID, NAME, LOCATION, VERSION, MIMETYPE, FOLDER FROM '{}'".format(self.name))
+
+        return {row[0]:row[1:] for row in self.cursor.fetchall()}
+
+    #This function lists every Drive folder, and every folder inside them if "drive_recursive" is set, on a pool of "drive_workers" threads.
+    #Pages of files are added to "seen" as they arrive, while other folders are still being listed, so the time it takes depends on the biggest folder rather than on all of them.
+    #It returns a dictionary of every folder that was listed to the one of "drive_folders" it is in.
+    def _list_drive(self, seen):
+
+        import queue
+        from concurrent.futures import ThreadPoolExecutor
+        from .drive import FOLDER
+
+        client = self.drive_client
+
+        #A file that is in more than one of our folders belongs to the first one.
+        order = {folder:i for i, folder in enumerate(self.drive_folders)}
+
+        tree = {}
+        futures = []
+
+        #Each thread puts the pages it lists on this queue, followed by None once it has finished.
+        pages = queue.Queue()
+
+        def pull(folder, root):
+            try:
+                for page in client.list_pages(folder):
+                    pages.put((page, root))
+            finally:
+                pages.put((None, root))
+
+        with ThreadPoolExecutor(self.drive_workers) as executor:
+
+            #This function starts listing a folder, and returns True if it did.
+            def submit(folder, root):
+
+                #A folder is only listed again if it is also in a folder that comes before the one it was found in, for example if the same subfolder is in two of our folders.
+                if folder in tree and order[tree[folder]] <= order[root]:
+                    return False
+
+                tree[folder] = root
+
+                self.logger.info("Updating Drive folder {}...".format(folder))
+
+                futures.append(executor.submit(pull, folder, root))
+
+                return True
+
+            #The number of folders that are still being listed.
+            listing = sum(submit(folder, folder) for folder in self.drive_folders)
+
+            while listing:
+
+                page, root = pages.get()
+
+                if page is None:
+                    listing -= 1
+                    continue
+
+                for file in page:
+
+                    #Folders aren't media, but with "drive_recursive" set, we list them too.
+                    if file.get('mimeType') == FOLDER:
+                        if self.drive_recursive:
+                            listing += submit(file['id'], root)
+                        continue
+
+                    row = seen.get(file['id'])
+
+                    if row is None or order[root] < order[row["FOLDER"]]:
+                        seen[file['id']] = _drive_row(file, root)
+
+        #If any folder couldn't be listed, we don't know which files are missing from it, so we give up before anything is deleted.
+        for future in futures:
+            future.result()
+
+        return tree
+
+    #This function sorts a list of Drive changes into files that we should have in our database, and files that we should not.
+    #With "drive_recursive" set, a folder inside ours that was added, moved, or deleted means files may have moved in or out of our folders without being in the changes, so we need to list every folder again. In that case it returns False.
+    def _drive_changes(self, changes, seen, deleted):
+
+        from .drive import FOLDER
+
+        #This is every folder we listed in the last full scan, along with the one of "drive_folders" it is in.
+        tree = json.loads(self._getstate("drive_tree", "null")) or {folder:folder for folder in self.drive_folders}
+
+        for change in changes:
+
+            file = change.get('file')
+
+            parents = {parent['id'] for parent in file.get('parents', [])} if file is not None else set()
+
+            if self.drive_recursive and (change['fileId'] in tree or (file is not None and file.get('mimeType') == FOLDER and parents & tree.keys())):
+                return False
+
+            roots = {tree[parent] for parent in parents if parent in tree}
+
+            folders = [folder for folder in self.drive_folders if folder in roots]
+
+            #Files that were deleted, trashed, or moved out of all of our folders are removed from the database, and so are folders, which aren't media.
+            if change.get('deleted') or file is None or file.get('labels', {}).get('trashed') or not folders or file.get('mimeType') == FOLDER:
+                seen.pop(change['fileId'], None)
+                deleted.add(change['fileId'])
+
+            #Anything else is either new, renamed, or has been moved into one of our folders.
+            else:
+                deleted.discard(change['fileId'])
+                seen[change['fileId']] = _drive_row(file, folders[0])
+
+        return True
+
+    #This function compares the files we found against the index of the database, and applies the differences in a single transaction.
+    #Files in the database that were neither seen nor unchanged are deleted, unless their location is in "keep", in which case only the IDs in "deleted" are.
+    #If a Drive changes token, the Drive folders we listed, or local folder modification times are given, they are saved in the same transaction.
+    #It returns a dictionary with the number of files that were added, renamed, modified and deleted.
+    def _reconcile(self, index, seen, unchanged=(), deleted=(), keep=(), token=None, folders=None, tree=None):
+
+        added = []
+        updated = []
+        renamed = 0
+        modified = []
+
+        #Remove the files we know haven't changed from our index.
+        #By doing this as we go, we will be left with the files that are in our database but not in any of our folders.
+        for id in unchanged:
+            index.pop(id, None)
+
+        for id, row in seen.items():
+
+            old = index.pop(id, None)
+
+            row["ID"] = id
+
+            #If the file DOES NOT exist in our database, it will be added.
+            if old is None:
+                row["PRIORITY"] = self.new_priority
+                added.append(row)
+                self.logger.info("ADDED: {} ({})".format(row["NAME"], id))
+                continue
+
+            #If anything about the file has changed, it will be updated.
+            if old != (row["NAME"], row["LOCATION"], row["VERSION"], row["MIMETYPE"], row["FOLDER"]):
+                updated.append(row)
+
+            if old[0] != row["NAME"]:
+                renamed += 1
+                self.logger.info("RENAMED: {} TO {}".format(old[0], row["NAME"]))
+
+            #Rows from before versions were recorded have no version, we fill it in without treating the file as modified.
+            if old[2] is not None and old[2] != row["VERSION"]:
+                modified.append(id)
+                self.logger.info("MODIFIED: {} ({})".format(row["NAME"], id))
+
+        #The remainder of the entries in the index are files that exist in our database, but were not found in any of the provided folders.
+        removed = []
+
+        for id, (name, location, version, mimetype, folder) in index.items():
+
+            if location not in keep or id in deleted:
+                removed.append({"ID":id})
+                self.logger.info("DELETED: {} ({})".format(name, id))
+
+        #Apply all of our changes in one transaction.
+        with self.connection:
+
+            self.cursor.executemany("""INSERT INTO '{}' (ID, NAME, LOCATION, POSTED, VERSION, SIZE, MTIME, MIMETYPE, HASH, FOLDER, PRIORITY)
+            VALUES (:ID, :NAME, :LOCATION, FALSE, :VERSION, :SIZE, :MTIME, :MIMETYPE, :HASH, :FOLDER, :PRIORITY)""".format(self.name), added)
+
+            #The hashes of local files are worked out later, so they are cleared here in case the file has changed.
+            self.cursor.executemany("""UPDATE '{}' SET NAME=:NAME, VERSION=:VERSION, SIZE=:SIZE, MTIME=:MTIME, MIMETYPE=:MIMETYPE, HASH=:HASH, PHASH=NULL, FOLDER=:FOLDER
+            WHERE ID=:ID""".format(self.name), updated)
+
+            self.cursor.executemany("DELETE FROM '{}' WHERE ID=:ID".format(self.name), removed)
+
+            #Anything we were holding on to for files that were modified or deleted is now out of date.
+            self._invalidate(modified + [row["ID"] for row in removed])
+
+            if self.selector is not None and (added or updated or removed):
+                self.selector.changed([row["ID"] for row in added + updated + removed])
+
+            if token is not None:
+                self._setstate("drive_token", token)
+                self._setstate("drive_folders", json.dumps(sorted(self.drive_folders)))
+                self._setstate("drive_recursive", json.dumps(self.drive_recursive))
+
+            if tree is not None:
+                self._setstate("drive_tree", json.dumps(tree))
+
+            if folders is not None:
+                from .local import LocalIndexer
+                LocalIndexer(self).save(folders)
+
+        changes = {"added":len(added), "renamed":renamed, "modified":len(modified), "deleted":len(removed)}
+
+        self.logger.info("{added} added, {renamed} renamed, {modified} modified, {deleted} deleted.".format(**changes))
+
+        return changes
+
+    #This function is called by updatedb, within its transaction, with the IDs of files that were modified or deleted.
+    def _invalidate(self, ids):
+
+        if self.cache is not None and ids:
+            self.cache.invalidate(ids)
+
+        if self.prefetcher is not None and ids:
+            self.prefetcher.invalidate(ids)
+
+    #This function hashes any local files that haven't been hashed yet, and sorts the database into groups of duplicates.
+    #Only one file from each group of duplicates is ever picked, see _select().
+    def _dedup(self, changes):
+
+        from concurrent.futures import ThreadPoolExecutor
+        from .dedup import fingerprint, group, components, HashIndex
+
+        self.cursor.execute("SELECT ID, MIMETYPE FROM '{}' WHERE HASH IS NULL AND LOCATION='LOCAL'".format(self.name))
+        rows = self.cursor.fetchall()
+
+        #Hashing means reading every new file in full, so it is spread across a pool of threads.
+        #Threads are used rather than processes, as starting processes would re-run the script that created the bot on platforms that spawn them, such as Windows and macOS.
+        if rows:
+
+            self.logger.info("Hashing {} files...".format(len(rows)))
+
+            hashes = []
+
+            with ThreadPoolExecutor(self.dedup_workers) as executor:
+
+                for (id, mimetype), result in zip(rows, executor.map(fingerprint, [row[0] for row in rows], [row[1] for row in rows])):
+
+                    if result is not None:
+                        hashes.append({"ID":id, "HASH":result[0], "PHASH":result[1]})
+
+            with self.connection:
+                self.cursor.executemany("UPDATE '{}' SET HASH=:HASH, PHASH=:PHASH WHERE ID=:ID".format(self.name), hashes)
+
+        rebuild = self._getstate("dedup_distance") != str(self.dedup_distance)
+
+        #If no files were added, modified or deleted, the groups haven't changed. Renaming or moving a file doesn't change its hashes.
+        if not rows and not any(changes.get(key) for key in ("added", "modified", "deleted")) and not rebuild:
+            return
+
+        index = HashIndex(self, self.dedup_distance)
+
+        #The index and the groups are changed in one transaction, so they always agree.
+        with self.connection:
+
+            #The first time, or if "dedup_distance" has changed, every file is grouped from scratch, which is faster to do in memory.
+            if rebuild:
+
+                self.cursor.execute("SELECT ID, HASH, PHASH FROM '{}'".format(self.name))
+                rows = self.cursor.fetchall()
+
+                groups = group(rows, self.dedup_distance)
+
+                ids = [row[0] for row in rows]
+
+                index.clear()
+                index.add([row for row in rows if row[1] is not None])
+
+            #Otherwise, only the files whose hashes have changed since they were grouped are looked up in the index, along with the groups they were in.
+            else:
+
+                removed, added = index.changes()
+
+                affected = {row[0] for row in added}
+
+                #A file that was removed from the index may have been what held its group together, so every file that was in a group with it is grouped again.
+                for id, exact, phash in removed:
+
+                    affected.add(id)
+
+                    for match in index.search(exact, phash):
+                        affected.update(self._group(match))
+
+                index.remove(removed)
+                index.add(added)
+
+                found = components(affected, index.matches)
+
+                #Every file in a group is represented by the smallest ID in it.
+                groups = {id:min(ids) for ids in found if len(ids) > 1 for id in ids}
+
+                ids = [id for ids in found for id in ids]
+
+            #Only the files that aren't the representative of their group are marked with the ID they are a duplicate of.
+            duplicates = {id:rep for id, rep in groups.items() if id != rep}
+
+            rows = []
+
+            #SQLite limits how many values can be given to one statement, so the files are read in chunks.
+            for start in range(0, len(ids), 500):
+
+                chunk = ids[start:start + 500]
+
+                self.cursor.execute("SELECT ID, GRP, POSTED FROM '{}' WHERE ID IN ({})".format(self.name, ",".join("?" * len(chunk))), chunk)
+                rows += self.cursor.fetchall()
+
+            updates = [{"ID":row[0], "GRP":duplicates.get(row[0])} for row in rows if row[1] != duplicates.get(row[0])]
+
+            #A group counts as posted if any file in it has been posted.
+            posted = {groups[row[0]] for row in rows if row[2] and row[0] in groups}
+
+            self.cursor.executemany("UPDATE '{}' SET GRP=:GRP WHERE ID=:ID".format(self.name), updates)
+
+            self.cursor.executemany("UPDATE '{}' SET POSTED=TRUE WHERE ID=:ID OR GRP=:ID".format(self.name), [{"ID":id} for id in posted])
+
+            self._setstate("dedup_distance", str(self.dedup_distance))
+
+            #Files that became, or stopped being, duplicates can now be picked, or can't.
+            if self.selector is not None:
+                self.selector.changed([row["ID"] for row in updates] + list(posted))
+
+        self.cursor.execute("SELECT COUNT(*) FROM '{}' WHERE GRP IS NOT NULL".format(self.name))
+
+        self.logger.info("Found {} duplicate files.".format(self.cursor.fetchone()[0]))
+
+    #This function returns the IDs of every file in the same group of duplicates as a file, including itself.
+    def _group(self, id):
+
+        self.cursor.execute("SELECT COALESCE(GRP, ID) FROM '{}' WHERE ID=:ID".format(self.name), {"ID":id})
+        row = self.cursor.fetchone()
+
+        self.cursor.execute("SELECT ID FROM '{}' WHERE ID=:ID OR GRP=:ID".format(self.name), {"ID":row[0] if row is not None else id})
+
+        return [row[0] for row in self.cursor.fetchall()]
+
+    #This function marks files as posted, along with any duplicates of them. It does not commit, so it can be made part of a larger transaction.
+    def _posted(self, ids):
+
+        import time
+
+        self.cursor.executemany("UPDATE '{}' SET POSTED=TRUE, LAST_POSTED=:TIME WHERE ID=:ID OR GRP=:ID".format(self.name), [{"ID":id, "TIME":time.time()} for id in ids])
+
+        if self.selector is not None:
+            self.selector.changed(ids)
+
+    #This function sets the priority of files, which multiplies how likely they are to be picked by a selection strategy. A priority of None is the same as 1.
+    def prioritize(self, ids, priority):
+
+        with self.connection:
+
+            self.cursor.executemany("UPDATE '{}' SET PRIORITY=:PRIORITY WHERE ID=:ID".format(self.name), [{"ID":id, "PRIORITY":priority} for id in ids])
+
+            if self.selector is not None:
+                self.selector.changed(ids)
+
     #This function sets the "Posted" value to false for all memebers in our database.
     def resetdb(self):
 
@@ -198,28 +744,63 @@ class Bot:
             with self.connection:
                 self.logger.info("Restting database...")
                 self.cursor.execute("UPDATE '{}' SET POSTED=FALSE".format(self.name))
+
+                if self.selector is not None:
+                    self.selector.changed()
                 self.logger.info("Database Reset!")
 
-    #This function downloads an image from Google Drive and returns a BytesIO object whith some special fields added.
-    def DownloadFromDrive(self, id):
-        
-        from io import BytesIO
+    #This function returns a dictionary of statistics about the bot's database.
+    def stats(self):
+
+        self.cursor.execute("SELECT LOCATION, COUNT(*), SUM(POSTED), SUM(GRP IS NOT NULL), SUM(POSTED=FALSE AND GRP IS NULL) FROM '{}' GROUP BY LOCATION".format(self.name))
+        rows = self.cursor.fetchall()
+
+        last_sync = self._getstate("last_sync")
+
+        stats = {"files":sum(row[1] for row in rows), "posted":sum(row[2] for row in rows), "duplicates":sum(row[3] for row in rows), "unposted":sum(row[4] for row in rows),
+                 "locations":{row[0]:row[1] for row in rows}, "last_sync":float(last_sync) if last_sync is not None else None}
+
+        if self.cache is not None:
+            stats["cache"] = self.cache.stats()
+
+        return stats
+
+    #This function downloads an image from Google Drive and returns a media object.
+    #If the bot has a cache and the version of the file is given, the file is served from the cache when possible, and added to it when not.
+    def DownloadFromDrive(self, id, version=None, name=None):
+
+        if self.cache is not None and version is not None:
+
+            media = self.cache.get(id, version, name)
+
+            if media is not None:
+                return media
+
+        from .metrics import counted
 
         self.logger.info("Fetching data from Google Drive...")
 
-        #Create a Google Drive file object of the media.
-        file = self.drive.CreateFile({'id': id})
-        
-        self.logger.info("DOWNLOADING: {} ({})".format(file['title'],file['id']))
+        with self.metrics.stage("download") as stage:
 
-        #We will now write the data from the media to a buffer (BytesIO).
-        self.logger.info("Writing data to buffer...")
-        
-        io = BytesIO()
+            #Get the file's metadata, and an iterable of its content.
+            file, chunks = self.drive_client.open_file(id)
+
+            self.logger.info("DOWNLOADING: {} ({})".format(file['title'],file['id']))
+
+            #The size of each chunk is added to the bytes of the stage as it is downloaded.
+            chunks = counted(chunks, stage)
+
+            if self.cache is not None:
+                return self.cache.put(id, _drive_version(file), file['title'], file['mimeType'], chunks)
+
+            #We will now write the data from the media to a buffer, which is moved to disk if the media is large.
+            self.logger.info("Writing data to buffer...")
 
-        #GetContentIOBuffer() returns a interable which we write a chunk of data at a time to a buffer.
-        for chunk in file.GetContentIOBuffer():
-           io.write(chunk)
+            io = self._spool()
+
+            #We write a chunk of data at a time to the buffer.
+            for chunk in chunks:
+               io.write(chunk)
 
         #Make sure that we set the seek to the beginning so our progrma starts reading the buffer from the front.
         io.seek(0)
@@ -230,43 +811,153 @@ class Bot:
         #Return the media object.
         return media
 
-    #The function downloads a random file from our database.
-    def GetRandom(self,no_repeat=True):
-        
+    #This function is called by the prefetcher on its background thread, once a file has been staged.
+    #Subclasses can override it to process media ahead of time, the base bot does nothing.
+    def _prestage(self, path, mimetype):
+        pass
+
+    #This function returns an empty file-like object to hold media.
+    #It is kept in memory until it grows past "spool_size" bytes, at which point it is moved to a temporary file, so that large media never has to fit in memory.
+    def _spool(self):
+
+        import tempfile
+
+        return tempfile.SpooledTemporaryFile(max_size=self.spool_size)
+
+    #This function picks a random row from our database, and returns its ID, name, location, version and MIME type.
+    #The pick is made inside SQLite, so only the chosen row is ever loaded into Python.
+    #If "reset" is False, None is returned when there is nothing left to pick, instead of resetting the database.
+    def _select(self, no_repeat=True, exclude=(), reset=True):
+
         import random
-    
+
         self.logger.info("Selecting media from database...")
 
-        #If we don't care about repeats, then just grab an entry.
-        if no_repeat == False:
-             self.cursor.execute("SELECT * FROM '{}'".format(self.name))
-             db = self.cursor.fetchall()
+        #Files that are being held back, such as posts waiting to be retried, are never picked.
+        held = self._held()
+        asked = exclude
+        exclude = set(exclude) | held
+
+        #If we don't care about repeats, then we can pick from any entry.
+        #Files that are duplicates of another file are never picked, so each group of duplicates is treated as one file.
+        where = "WHERE POSTED=FALSE AND GRP IS NULL" if no_repeat else "WHERE GRP IS NULL"
+
+        count = self._count(where, exclude, no_repeat)
+
+        if count == 0 and not reset:
+            return None
+
+        #If all the files have been posted, reset the database.
+        #Files that are held back haven't been posted yet, so if they are all that is left, the database isn't reset.
+        if count == 0 and no_repeat and not (held and self._count(where, asked, no_repeat)):
+            self.logger.info("Have posted all photos!")
+
+            self.resetdb()
+
+            count = self._count(where, exclude, no_repeat)
+            self.logger.info("Selecting media from database...")
+
+        if count == 0:
+            raise IndexError("There is no media in the database!")
 
+        #If the bot has a selection strategy, its sampler picks the file using their weights.
+        if self.selector is not None:
+            row = self.selector.pick(no_repeat, exclude)
+
+        #Choosing a random offset into the files we can pick from gives every file the same chance of being chosen.
+        #Files we were asked to exclude are skipped by picking again, which keeps the count above cheap.
         else:
-            #Grab a list of files that haven't been posted from the database.
-            self.cursor.execute("SELECT * FROM '{}' WHERE POSTED=FALSE".format(self.name))
-            db = self.cursor.fetchall()
-        
-            #If all the files have been posted, reset the database.
-            if db == []:
-                self.logger.info("Have posted all photos!")
-                
-                self.resetdb()
-                
-                #Get an array of all members of the database.
-                self.cursor.execute("SELECT * FROM '{}' WHERE POSTED=FALSE".format(self.name))
-                db = self.cursor.fetchall()
-                self.logger.info("Selecting media from database...")
-
-        #Choose a random row in our database.
-        row = random.choice(db)
+
+            while True:
+
+                self.cursor.execute("SELECT ID, NAME, LOCATION, VERSION, MIMETYPE FROM '{}' {} LIMIT 1 OFFSET :OFFSET".format(self.name, where),
+                {"OFFSET":random.randrange(count + len(exclude))})
+                row = self.cursor.fetchone()
+
+                if row is not None and row[0] not in exclude:
+                    break
+
         self.logger.info("Selected {} ({})!".format(row[1], row[0]))
 
+        return row
+
+    #This function returns the IDs of files that must not be picked for now. Subclasses override it, the base bot holds nothing back.
+    def _held(self):
+        return set()
+
+    #This function counts the files we can pick from, leaving out the excluded files.
+    #When picking from unposted files, this only has to read the index on POSTED.
+    #If the bot has a selection strategy, its sampler counts the files instead, leaving out any with a weight of 0.
+    def _count(self, where, exclude, no_repeat=True):
+
+        if self.selector is not None:
+            return self.selector.count(no_repeat, exclude)
+
+        self.cursor.execute("SELECT COUNT(*) FROM '{}' {}".format(self.name, where))
+        count = self.cursor.fetchone()[0]
+
+        for id in exclude:
+            self.cursor.execute("SELECT COUNT(*) FROM '{}' WHERE ID=:ID {}".format(self.name, where.replace("WHERE", "AND")), {"ID":id})
+            count -= self.cursor.fetchone()[0]
+
+        return count
+
+    #The function downloads a random file from our database.
+    def GetRandom(self,no_repeat=True):
+
+        with self.metrics.stage("get_random") as stage:
+
+            #If media was prefetched by the last post, use it.
+            if self.prefetcher is not None:
+
+                media = self.prefetcher.take(no_repeat)
+
+                if media is not None:
+                    stage.outcome = "prefetched"
+                    return media
+
+            return self._open(*self._select(no_repeat))
+
+    #This function downloads a batch of up to "size" random files from our database, which can be posted together.
+    #Only files that _batchable() allows can share a post, so if the first file picked can't, it is returned on its own.
+    def GetBatch(self, size, no_repeat=True):
+
+        batch = [self.GetRandom(no_repeat)]
+
+        if not self._batchable(batch[0].mimetype):
+            return batch
+
+        exclude = {batch[0].id}
+
+        #Each extra file gets one pick, a file that can't share a post is left for a later post.
+        #The database is never reset part way through a batch, so a batch can be cut short when there is nothing left to pick.
+        for attempt in range(size - 1):
+
+            row = self._select(no_repeat, exclude, reset=False)
+
+            if row is None:
+                break
+
+            exclude.add(row[0])
+
+            if self._batchable(row[4]):
+                batch.append(self._open(*row))
+
+        return batch
+
+    #This function returns True if media with the given MIME type can be posted along with other media.
+    #Subclasses override it with the rules of their platform, the base bot allows anything.
+    def _batchable(self, mimetype):
+        return True
+
+    #This function returns a media object for a row in our database.
+    def _open(self, id, name, location, version, mimetype):
+
         #return a media object downloaded from Drive.
-        if row[2] == "DRIVE":
-            return self.DownloadFromDrive(row[0])
+        if location == "DRIVE":
+            return self.DownloadFromDrive(id, version, name)
 
         #If it is a local file, then return a media object made out of the file.
-        elif row[2] == "LOCAL":
+        elif location == "LOCAL":
             import mimetypes
-            return Media(open(row[0],"rb"), mimetypes.guess_type(row[0])[0],row[1],row[0])
\ No newline at end of file
+            return Media(open(id,"rb"), mimetype or mimetypes.guess_type(id)[0],name,id)
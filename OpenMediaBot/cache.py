@@ -0,0 +1,204 @@
+import os
+
+import time
+
+import hashlib
+
+import shutil
+
+from .bot import Media
+
+#This class keeps copies of Drive media on disk, so that a file doesn't have to be downloaded again every time it is picked.
+#Entries are keyed by the file's Drive ID and version, and the least recently used entries are removed once the cache grows past its size limit.
+#The index of the cache is stored in the bot's database, in a table named after the bot.
+class MediaCache:
+
+    def __init__(self, bot):
+
+        #We use the bot's database connection and settings.
+        self.bot = bot
+
+        self.directory = bot.cache_dir
+        self.max_size = bot.cache_size
+
+        self.table = "{}_CACHE".format(bot.name)
+
+        os.makedirs(self.directory, exist_ok=True)
+
+        with bot.connection:
+
+            bot.cursor.execute("""CREATE TABLE IF NOT EXISTS '{}' (
+            ID text PRIMARY KEY,
+            VERSION text,
+            MIMETYPE text,
+            PATH text NOT NULL,
+            SIZE integer NOT NULL,
+            USED real NOT NULL);""".format(self.table))
+
+            #This index allows us to find the least recently used entries quickly.
+            bot.cursor.execute("CREATE INDEX IF NOT EXISTS '{0}_USED' ON '{0}' (USED);".format(self.table))
+
+    #These are the number of times media was found in the cache, not found in the cache, and removed from the cache to make room.
+    #They are kept in the bot's state, so they add up over every run of the bot.
+    @property
+    def hits(self):
+        return int(self.bot._getstate("cache_hits", 0))
+
+    @property
+    def misses(self):
+        return int(self.bot._getstate("cache_misses", 0))
+
+    @property
+    def evictions(self):
+        return int(self.bot._getstate("cache_evictions", 0))
+
+    def _count(self, counter, amount=1):
+        self.bot._setstate(counter, int(self.bot._getstate(counter, 0)) + amount)
+
+    #This function returns a media object for a cached file, or None if the file is not cached at the given version.
+    def get(self, id, version, name):
+
+        cursor = self.bot.cursor
+
+        cursor.execute("SELECT VERSION, MIMETYPE, PATH FROM '{}' WHERE ID=:ID".format(self.table), {"ID":id})
+        row = cursor.fetchone()
+
+        with self.bot.connection:
+
+            if row is not None and row[0] == version and os.path.exists(row[2]):
+
+                cursor.execute("UPDATE '{}' SET USED=:USED WHERE ID=:ID".format(self.table), {"USED":time.time(), "ID":id})
+
+                self._count("cache_hits")
+
+                self.bot.logger.info("CACHE HIT: {} ({})".format(name, id))
+
+                return Media(open(row[2], "rb"), row[1], name, id)
+
+            #An entry for an older version of the file is no use to us anymore.
+            if row is not None:
+                self._remove([id])
+
+            self._count("cache_misses")
+
+        return None
+
+    #This function returns the path of a cached file, or None if the file is not cached at the given version.
+    #Unlike get(), it doesn't count as a hit or a miss, or as a use of the file.
+    def path(self, id, version):
+
+        self.bot.cursor.execute("SELECT VERSION, PATH FROM '{}' WHERE ID=:ID".format(self.table), {"ID":id})
+        row = self.bot.cursor.fetchone()
+
+        if row is not None and row[0] == version and os.path.exists(row[1]):
+            return row[1]
+
+        return None
+
+    #This function writes a file to the cache from an iterable of chunks, and returns a media object for it.
+    def put(self, id, version, name, mimetype, chunks):
+
+        path = self._path(id)
+
+        #We download to a temporary name first, so that a partial download is never mistaken for a cached file.
+        with open(path + ".part", "wb") as file:
+            for chunk in chunks:
+                file.write(chunk)
+
+        os.replace(path + ".part", path)
+
+        return self._add(id, version, name, mimetype, path)
+
+    #This function moves a file that has already been downloaded (by the prefetcher, for example) into the cache, and returns a media object for it.
+    def adopt(self, id, version, name, mimetype, source):
+
+        path = self._path(id)
+
+        #The file may be on a different drive than the cache, in which case it is copied to a temporary name first.
+        shutil.move(source, path + ".part")
+        os.replace(path + ".part", path)
+
+        return self._add(id, version, name, mimetype, path)
+
+    #Files are named by a hash of their ID, since Drive IDs aren't guaranteed to be valid file names everywhere.
+    def _path(self, id):
+        return os.path.join(self.directory, hashlib.sha1(id.encode()).hexdigest())
+
+    #This function adds a file in the cache directory to the index, and removes old entries if the cache is too big.
+    def _add(self, id, version, name, mimetype, path):
+
+        with self.bot.connection:
+
+            self.bot.cursor.execute("INSERT OR REPLACE INTO '{}' VALUES (:ID, :VERSION, :MIMETYPE, :PATH, :SIZE, :USED)".format(self.table),
+            {"ID":id, "VERSION":version, "MIMETYPE":mimetype, "PATH":path, "SIZE":os.path.getsize(path), "USED":time.time()})
+
+            self._evict(keep=id)
+
+        return Media(open(path, "rb"), mimetype, name, id)
+
+    #This function removes the least recently used entries until the cache fits in its size limit.
+    #The entry we just added is never removed, so a single file larger than the limit is kept until the next file is cached.
+    def _evict(self, keep):
+
+        cursor = self.bot.cursor
+
+        cursor.execute("SELECT SUM(SIZE) FROM '{}'".format(self.table))
+        size = cursor.fetchone()[0] or 0
+
+        if size <= self.max_size:
+            return
+
+        cursor.execute("SELECT ID, SIZE FROM '{}' WHERE ID!=:ID ORDER BY USED".format(self.table), {"ID":keep})
+
+        evict = []
+
+        for id, entry_size in cursor.fetchall():
+
+            if size <= self.max_size:
+                break
+
+            evict.append(id)
+            size -= entry_size
+
+        self._remove(evict)
+
+        self._count("cache_evictions", len(evict))
+
+    #This function removes entries from the cache, along with their files.
+    def _remove(self, ids):
+
+        cursor = self.bot.cursor
+
+        for id in ids:
+
+            cursor.execute("SELECT PATH FROM '{}' WHERE ID=:ID".format(self.table), {"ID":id})
+            row = cursor.fetchone()
+
+            if row is None:
+                continue
+
+            try:
+                os.remove(row[0])
+
+            #If the file is already gone, there's nothing left to remove.
+            except FileNotFoundError:
+                pass
+
+            cursor.execute("DELETE FROM '{}' WHERE ID=:ID".format(self.table), {"ID":id})
+
+    #This function removes any entries for files that were modified or deleted. It is called by updatedb.
+    def invalidate(self, ids):
+        self._remove(ids)
+
+    #This function returns a dictionary of statistics about the cache, which can be used to choose a good size for it.
+    def stats(self):
+
+        self.bot.cursor.execute("SELECT COUNT(*), SUM(SIZE) FROM '{}'".format(self.table))
+        entries, size = self.bot.cursor.fetchone()
+
+        hits = self.hits
+        misses = self.misses
+
+        return {"hits":hits, "misses":misses, "evictions":self.evictions,
+                "hit_rate":hits / (hits + misses) if hits + misses else 0.0,
+                "entries":entries, "size":size or 0, "max_size":self.max_size}
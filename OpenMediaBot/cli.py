@@ -0,0 +1,80 @@
+#This module is OpenMediaBot's command line interface, which is run with "python -m OpenMediaBot" or the "openmediabot" command.
+#It is meant to be run often, by cron for example, so it only imports what the command needs, and bots only connect to Google Drive and Twitter when they first use them.
+import sys
+
+import json
+
+#The classes a bot can be, by the name used for them in configuration files, along with the module they are in.
+_CLASSES = {"Bot":".bot", "TwitterBot":".twitter_bot"}
+
+#This function creates a bot from a JSON configuration file.
+#Along with the bot's usual configuration options, the file may contain "class" ("TwitterBot" or "Bot") and "twitter_credfile", like the scheduler's configuration files.
+def load(configfile):
+
+    from importlib import import_module
+
+    with open(configfile) as jsonfile:
+        config = json.load(jsonfile)
+
+    name = config.get("class", "TwitterBot")
+
+    if name not in _CLASSES:
+        raise ValueError("Unknown bot class {}. The bot classes are: {}.".format(name, ", ".join(_CLASSES)))
+
+    kwargs = {}
+
+    if "twitter_credfile" in config:
+        kwargs["twitter_credfile"] = config["twitter_credfile"]
+
+    return getattr(import_module(_CLASSES[name], __package__), name)(configfile=configfile, **kwargs)
+
+def main(args=None):
+
+    import argparse
+
+    parser = argparse.ArgumentParser(prog="openmediabot", description="Run an OpenMediaBot bot from its configuration file.")
+    parser.add_argument("configfile", help="The bot's JSON configuration file.")
+
+    commands = parser.add_subparsers(dest="command", metavar="command")
+    commands.required = True
+
+    post = commands.add_parser("post", help="Post a random piece of media, updating the database first if it is older than --max-age.")
+    post.add_argument("--no-sync", action="store_true", help="Don't update the database before posting.")
+
+    sync = commands.add_parser("sync", help="Update the database, if it is older than --max-age.")
+    sync.add_argument("--force", action="store_true", help="Update the database no matter how recently it was last updated.")
+
+    for command in (post, sync):
+        command.add_argument("--max-age", type=float, help="Skip updating the database if it was last updated less than this many seconds ago. Overrides the bot's sync_max_age.")
+
+    commands.add_parser("reset", help="Mark every file as not posted.")
+    commands.add_parser("stats", help="Print statistics about the bot's database as JSON.")
+
+    args = parser.parse_args(args)
+
+    bot = load(args.configfile)
+
+    if getattr(args, "max_age", None) is not None:
+        bot.sync_max_age = args.max_age
+
+    if args.command == "post":
+
+        if not hasattr(bot, "post"):
+            parser.error("Bots of class {} can't post.".format(type(bot).__name__))
+
+        #A post that fails is logged by the bot, and we exit with an error so that it is noticed by whatever is running us.
+        return 1 if bot.post(updatedb=not args.no_sync) == "error" else 0
+
+    elif args.command == "sync":
+        bot.updatedb(force=args.force)
+
+    elif args.command == "reset":
+        bot.resetdb()
+
+    elif args.command == "stats":
+        print(json.dumps(bot.stats(), indent=2))
+
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,265 @@
+import hashlib
+
+#This function returns the exact and perceptual hashes of a local file, as hex strings.
+#The exact hash is an MD5 checksum, the same as Google Drive uses, so local files and Drive files can be matched.
+#The perceptual hash is only calculated for images, and is None for anything else.
+#If the file can't be read, it returns None, rather than stopping the other files from being hashed.
+#It can be run on several threads at once, as hashlib and Pillow release the GIL while they work.
+def fingerprint(path, mimetype):
+
+    digest = hashlib.md5()
+
+    try:
+        with open(path, "rb") as file:
+            for chunk in iter(lambda: file.read(1048576), b""):
+                digest.update(chunk)
+
+    except OSError:
+        return None
+
+    phash = None
+
+    if mimetype is not None and mimetype.startswith("image/"):
+
+        try:
+            phash = "{:016x}".format(dhash(path))
+
+        #If PIL can't read the image, we can still find exact duplicates of it.
+        except Exception:
+            pass
+
+    return digest.hexdigest(), phash
+
+#This function calculates a 64 bit difference hash of an image.
+#The image is shrunk to 9x8 pixels in grayscale, and each bit records whether a pixel is brighter than the one to its right.
+#Images that look the same have hashes that differ in only a few bits, even if they have been resized or recompressed.
+def dhash(path):
+
+    from PIL import Image
+
+    with Image.open(path) as im:
+
+        #Decoding a smaller version of a JPEG is a lot faster, and doesn't change the hash.
+        im.draft("L", (64, 64))
+
+        pixels = list(im.convert("L").resize((9, 8)).getdata())
+
+    value = 0
+
+    for row in range(8):
+        for column in range(8):
+            value = value << 1 | (pixels[row * 9 + column] > pixels[row * 9 + column + 1])
+
+    return value
+
+#This function counts the bits that are set in an integer, using int.bit_count() where it is available (Python 3.10 and later), as it is a lot faster.
+_popcount = getattr(int, "bit_count", lambda value: bin(value).count("1"))
+
+def distance(a, b):
+    return _popcount(a ^ b)
+
+#This function splits a 64 bit perceptual hash into "radius" + 1 bands of bits, and returns a list of (band, bits) pairs.
+#Two hashes that differ in at most "radius" bits can't differ in every band, so they are always the same in at least one (this is called multi-index hashing).
+#That means only hashes that share a band with a hash need to be compared with it.
+def bands(value, radius):
+
+    if not 0 <= radius < 64:
+        raise ValueError("The distance between perceptual hashes must be from 0 to 63 bits.")
+
+    count = radius + 1
+
+    found = []
+
+    for band in range(count):
+
+        start = 64 * band // count
+        end = 64 * (band + 1) // count
+
+        found.append((band, (value >> start) & ((1 << (end - start)) - 1)))
+
+    return found
+
+#This function finds the groups of files that are connected by matches, starting from the given IDs.
+#"matches" is a function that takes an ID and returns the IDs of the files that match it.
+#It returns a list of groups, which are sets of IDs, including a group of one for each file with no matches.
+def components(ids, matches):
+
+    seen = set()
+    found = []
+
+    for id in ids:
+
+        if id in seen:
+            continue
+
+        seen.add(id)
+
+        component = {id}
+        stack = [id]
+
+        while stack:
+            for match in matches(stack.pop()):
+                if match not in seen:
+                    seen.add(match)
+                    component.add(match)
+                    stack.append(match)
+
+        found.append(component)
+
+    return found
+
+#This class is an index of exact and perceptual hashes kept in memory, which finds every file that matches a hash.
+#Files match if they have the same exact hash, or perceptual hashes within "radius" bits of each other.
+class BandIndex:
+
+    def __init__(self, radius):
+
+        self.radius = radius
+
+        #The IDs of the files with each exact hash, and the IDs and perceptual hashes of the files with each band of a perceptual hash.
+        self.exact = {}
+        self.bands = {}
+
+    def add(self, id, exact, phash):
+
+        phash = int(phash, 16) if phash is not None else None
+
+        if exact is not None:
+            self.exact.setdefault(exact, []).append(id)
+
+        if phash is not None:
+            for band in bands(phash, self.radius):
+                self.bands.setdefault(band, []).append((id, phash))
+
+    #This function returns the IDs of every file in the index that matches the given hashes.
+    def search(self, exact, phash):
+
+        phash = int(phash, 16) if phash is not None else None
+
+        found = set(self.exact.get(exact, ())) if exact is not None else set()
+
+        if phash is not None:
+            for band in bands(phash, self.radius):
+                for other, value in self.bands.get(band, ()):
+                    if _popcount(phash ^ value) <= self.radius:
+                        found.add(other)
+
+        return found
+
+#This class is the index of the hashes that the bot's duplicate groups were worked out from, which is kept in its database.
+#It allows the files that match a new or changed file to be found without loading the hashes of the whole library.
+#The hashes are kept in a table of their own, so that files whose hashes have changed since they were grouped can be found by comparing it with the bot's table.
+#Each band of the perceptual hashes is kept in another table, see bands().
+class HashIndex:
+
+    def __init__(self, bot, radius):
+
+        self.bot = bot
+        self.radius = radius
+
+    #This function returns two lists of (ID, exact hash, perceptual hash) tuples: the files to remove from the index as they were indexed, and the files to add to it.
+    #Files that were deleted, or whose hashes were cleared, are removed, new files are added, and files whose hashes have changed are in both.
+    def changes(self):
+
+        self.bot.cursor.execute("""SELECT H.ID, H.HASH, H.PHASH FROM '{0}_HASHES' H LEFT JOIN '{0}' T ON T.ID=H.ID
+        WHERE T.HASH IS NOT H.HASH OR T.PHASH IS NOT H.PHASH""".format(self.bot.name))
+        removed = self.bot.cursor.fetchall()
+
+        self.bot.cursor.execute("""SELECT T.ID, T.HASH, T.PHASH FROM '{0}' T LEFT JOIN '{0}_HASHES' H ON H.ID=T.ID
+        WHERE T.HASH IS NOT NULL AND (H.ID IS NULL OR T.HASH IS NOT H.HASH OR T.PHASH IS NOT H.PHASH)""".format(self.bot.name))
+        added = self.bot.cursor.fetchall()
+
+        return removed, added
+
+    #These functions change the index. They do not commit, so they can be made part of a larger transaction.
+    def add(self, rows):
+
+        self.bot.cursor.executemany("INSERT OR REPLACE INTO '{}_HASHES' VALUES (?, ?, ?)".format(self.bot.name), rows)
+
+        self.bot.cursor.executemany("INSERT OR IGNORE INTO '{}_BANDS' VALUES (?, ?, ?)".format(self.bot.name), self._bands(rows))
+
+    def remove(self, rows):
+
+        self.bot.cursor.executemany("DELETE FROM '{}_HASHES' WHERE ID=?".format(self.bot.name), [(row[0],) for row in rows])
+
+        self.bot.cursor.executemany("DELETE FROM '{}_BANDS' WHERE BAND=? AND BITS=? AND ID=?".format(self.bot.name), self._bands(rows))
+
+    def clear(self):
+
+        self.bot.cursor.execute("DELETE FROM '{}_HASHES'".format(self.bot.name))
+        self.bot.cursor.execute("DELETE FROM '{}_BANDS'".format(self.bot.name))
+
+    def _bands(self, rows):
+        return [(band, bits, id) for id, exact, phash in rows if phash is not None for band, bits in bands(int(phash, 16), self.radius)]
+
+    #This function returns the IDs of every file in the index that matches the given hashes.
+    def search(self, exact, phash):
+
+        found = set()
+
+        if exact is not None:
+            self.bot.cursor.execute("SELECT ID FROM '{}_HASHES' WHERE HASH=?".format(self.bot.name), (exact,))
+            found.update(row[0] for row in self.bot.cursor.fetchall())
+
+        if phash is not None:
+
+            phash = int(phash, 16)
+
+            for band, bits in bands(phash, self.radius):
+
+                self.bot.cursor.execute("""SELECT H.ID, H.PHASH FROM '{0}_BANDS' B JOIN '{0}_HASHES' H ON H.ID=B.ID
+                WHERE B.BAND=? AND B.BITS=?""".format(self.bot.name), (band, bits))
+
+                found.update(id for id, other in self.bot.cursor.fetchall() if distance(phash, int(other, 16)) <= self.radius)
+
+        return found
+
+    #This function returns the IDs of every file in the index that matches a file in the index, including itself, or nothing if the file isn't in the index.
+    def matches(self, id):
+
+        self.bot.cursor.execute("SELECT HASH, PHASH FROM '{}_HASHES' WHERE ID=?".format(self.bot.name), (id,))
+        row = self.bot.cursor.fetchone()
+
+        return self.search(*row) if row is not None else set()
+
+#This function sorts files into groups of duplicates, given a list of (ID, exact hash, perceptual hash) tuples.
+#Files are in the same group if they have the same exact hash, or perceptual hashes within "radius" bits of each other.
+#It returns a dictionary from the ID of every file that has duplicates to the ID that represents its group, which is the smallest ID in the group.
+def group(rows, radius):
+
+    #This is a union-find structure, where each ID points towards the representative of its group.
+    parent = {}
+
+    def find(id):
+
+        while parent[id] != id:
+            parent[id] = parent[parent[id]]
+            id = parent[id]
+
+        return id
+
+    def union(a, b):
+
+        a, b = find(a), find(b)
+
+        if a != b:
+            parent[max(a, b)] = min(a, b)
+
+    index = BandIndex(radius)
+
+    #Each file is only compared with the files before it, so every pair of files is only compared once.
+    for id, exact, phash in rows:
+
+        parent[id] = id
+
+        for match in index.search(exact, phash):
+            union(id, match)
+
+        index.add(id, exact, phash)
+
+    groups = {}
+
+    for id in parent:
+        groups.setdefault(find(id), []).append(id)
+
+    return {id:min(ids) for ids in groups.values() if len(ids) > 1 for id in ids}
@@ -0,0 +1,126 @@
+#This module contains the clients that bots use to talk to Google Drive.
+#A bot only ever talks to Drive through the methods of DriveClient, so any object that implements them (a fake Drive for testing, for example) can be passed to a bot using the "drive_client" option.
+
+import threading
+
+#These are the only fields of a file that bots use, so they are all we ask Drive for.
+FIELDS = "id,title,mimeType,md5Checksum,modifiedDate,fileSize"
+
+#Folders are files with this MIME type.
+FOLDER = "application/vnd.google-apps.folder"
+
+#This exception is raised when Google Drive no longer accepts a changes token, for example if it has expired.
+class InvalidTokenError(Exception):
+    pass
+
+#This is the interface that every Drive client must implement.
+#Files are represented as dictionaries using the field names of the Google Drive v2 API, such as "id", "title" and "mimeType".
+class DriveClient:
+
+    #Returns a list of the files in a folder that are not in the trash.
+    def list_folder(self, folder_id):
+        raise NotImplementedError
+
+    #Yields the files in a folder that are not in the trash a page (a list of files) at a time, so they can be used while the rest are still being listed.
+    #This may be called from several threads at once. Clients that don't page through folders don't need to implement it, the whole folder is then one page.
+    def list_pages(self, folder_id):
+        yield self.list_folder(folder_id)
+
+    #Returns a token which marks the current position in the Drive changes feed.
+    def get_start_token(self):
+        raise NotImplementedError
+
+    #Returns a tuple of (changes, token), where changes is a list of everything that changed since the given token and token is the position to continue from next time.
+    #Each change is a dictionary with a "fileId", a "deleted" flag and, unless the file was deleted, a "file" dictionary that includes its "parents" and "labels".
+    #Raises InvalidTokenError if the token is not accepted.
+    def list_changes(self, token):
+        raise NotImplementedError
+
+    #Returns a tuple of (file, chunks), where file is a dictionary of the file's metadata and chunks is an iterable of the file's content.
+    def open_file(self, id):
+        raise NotImplementedError
+
+#This client uses PyDrive2 to talk to the real Google Drive.
+class PyDriveClient(DriveClient):
+
+    def __init__(self, drive, chunk_size=1048576, page_size=1000):
+
+        #This is an authenticated GoogleDrive object.
+        self.drive = drive
+
+        #The size of each chunk we download at a time, this is how much of a file we hold in memory at once.
+        self.chunk_size = chunk_size
+
+        #The number of files Drive sends us in each page of a folder.
+        self.page_size = page_size
+
+        #Folders are listed on several threads, but only one of them should authenticate.
+        self.lock = threading.Lock()
+
+        #PyDrive2's LoadAuth decorator expects these attributes, it makes sure we are authenticated before each call.
+        self.auth = drive.auth
+        self.http = None
+
+    #This makes sure we are authenticated, and returns the Drive API service along with the HTTP object to use with it.
+    def _service(self):
+
+        from pydrive2.auth import LoadAuth
+
+        return LoadAuth(lambda self: (self.auth.service, self.http))(self)
+
+    def list_folder(self, folder_id):
+        return [file for page in self.list_pages(folder_id) for file in page]
+
+    def list_pages(self, folder_id):
+
+        with self.lock:
+            self._service()
+
+        #Iterating over a file list fetches it a page at a time. PyDrive2 uses a separate HTTP connection for each thread, so this is safe to do on several threads.
+        for page in self.drive.ListFile({'q': "'{}' in parents and trashed=false".format(folder_id), 'maxResults': self.page_size, 'fields': "nextPageToken,items({})".format(FIELDS)}):
+            yield page
+
+    def get_start_token(self):
+
+        service, http = self._service()
+
+        return service.changes().getStartPageToken().execute(http=http)["startPageToken"]
+
+    def list_changes(self, token):
+
+        from googleapiclient.errors import HttpError
+
+        service, http = self._service()
+
+        changes = []
+
+        #The changes feed is paged, so we keep requesting pages until Drive gives us a token for the next run.
+        while True:
+
+            try:
+                response = service.changes().list(pageToken=token, includeDeleted=True, maxResults=1000,
+                fields="nextPageToken,newStartPageToken,items(fileId,deleted,file({},parents(id),labels(trashed)))".format(FIELDS)).execute(http=http)
+
+            #Drive answers with a 400 or 404 when a token is invalid or has expired.
+            except HttpError as e:
+                if e.resp.status in (400, 404):
+                    raise InvalidTokenError(str(e))
+                raise
+
+            changes.extend(response.get("items", []))
+
+            if "newStartPageToken" in response:
+                return changes, response["newStartPageToken"]
+
+            token = response["nextPageToken"]
+
+    def open_file(self, id):
+
+        #Create a Google Drive file object of the media.
+        file = self.drive.CreateFile({'id': id})
+
+        file.FetchMetadata()
+
+        #GetContentIOBuffer() returns an iterable which gives us a chunk of data at a time.
+        #By default, these chunks are 100MB, so we ask for smaller ones.
+        return file, file.GetContentIOBuffer(chunksize=self.chunk_size)
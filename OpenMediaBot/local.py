@@ -0,0 +1,198 @@
+import os
+
+import mimetypes
+
+#These are the first bytes of common media formats, along with their MIME types.
+#RIFF and ISO media files are identified by bytes further into the file, and are handled separately.
+_SIGNATURES = [
+    (b"\xff\xd8\xff", "image/jpeg"),
+    (b"\x89PNG\r\n\x1a\n", "image/png"),
+    (b"GIF87a", "image/gif"),
+    (b"GIF89a", "image/gif"),
+    (b"BM", "image/bmp"),
+    (b"II*\x00", "image/tiff"),
+    (b"MM\x00*", "image/tiff"),
+    (b"\x1aE\xdf\xa3", "video/webm"),
+    (b"ID3", "audio/mpeg"),
+    (b"\xff\xfb", "audio/mpeg"),
+    (b"OggS", "audio/ogg"),
+    (b"fLaC", "audio/flac"),
+]
+
+_RIFF = {b"WEBP":"image/webp", b"AVI ":"video/x-msvideo", b"WAVE":"audio/wav"}
+
+#These are the kinds of files we keep in the database, anything else in a local folder is skipped.
+MEDIA_TYPES = ("image/", "video/", "audio/")
+
+#This function works out the MIME type of a file from its first few bytes, falling back to its extension.
+def sniff(path):
+
+    try:
+        with open(path, "rb") as file:
+            header = file.read(16)
+
+    except OSError:
+        return None
+
+    for signature, mimetype in _SIGNATURES:
+        if header.startswith(signature):
+            return mimetype
+
+    if header[:4] == b"RIFF" and header[8:12] in _RIFF:
+        return _RIFF[header[8:12]]
+
+    #MP4 and QuickTime files start with the size of their first box, followed by "ftyp".
+    if header[4:8] == b"ftyp":
+        return "video/quicktime" if header[8:12] == b"qt  " else "video/mp4"
+
+    return mimetypes.guess_type(path)[0]
+
+#These functions return the keys we group files and folders by.
+#Paths are compared the same way they are built with os.path.join, so "folder" and "folder/" are treated the same.
+def _key(folder):
+    return os.path.dirname(os.path.join(folder, ""))
+
+def _parent(path):
+    return os.path.dirname(_key(path))
+
+#This class scans local folders, including their subfolders, for media.
+#The modification time of every folder is stored in the database, and a folder that hasn't changed since the last scan isn't listed again.
+#Only the files we already know about in it are checked, by comparing their size and modification time, so a rescan costs about one stat() per file.
+class LocalIndexer:
+
+    def __init__(self, bot):
+
+        #We use the bot's database connection and settings.
+        self.bot = bot
+
+        self.table = "{}_DIRS".format(bot.name)
+
+    #This function scans the bot's local folders, given the bot's index of files (ID to a tuple of its name, location, version, MIME type and folder).
+    #It returns a dictionary of files that are new or have changed, a set of the IDs of files that haven't changed, and a dictionary of folders and their modification times.
+    def scan(self, index):
+
+        from concurrent.futures import ThreadPoolExecutor
+
+        cursor = self.bot.cursor
+
+        cursor.execute("SELECT PATH, MTIME FROM '{}'".format(self.table))
+        stored = dict(cursor.fetchall())
+
+        #The folders and files from the last scan, grouped by the folder they are in.
+        subfolders = {}
+
+        for folder in stored:
+            subfolders.setdefault(_parent(folder), []).append(folder)
+
+        files = {}
+
+        for id, row in index.items():
+            if row[1] == "LOCAL":
+                files.setdefault(os.path.dirname(id), []).append(id)
+
+        found = {}
+        unchanged = set()
+        folders = {}
+
+        #Each folder is scanned along with the one of the bot's folders it is in, which is stored as the folder of its files.
+        stack = [(folder, folder) for folder in self.bot.local_folders]
+
+        while stack:
+
+            folder, root = stack.pop()
+
+            #A folder can be reached more than once, for example if it is inside another of the bot's folders.
+            if folder in folders:
+                continue
+
+            try:
+                mtime = os.stat(folder).st_mtime_ns
+
+            #If a subfolder has been deleted, its files will be too.
+            #If one of the bot's folders is missing, though (an unmounted drive, for example), we can't tell whether its files were deleted, so we give up before anything is.
+            except FileNotFoundError:
+
+                if folder == root:
+                    raise
+
+                continue
+
+            folders[folder] = mtime
+
+            #A folder's modification time changes whenever a file is added to it or removed from it.
+            #If it hasn't changed, we already know what is in it, and only need to check if any of those files were modified.
+            if stored.get(folder) == mtime:
+
+                stack.extend((subfolder, root) for subfolder in subfolders.get(_key(folder), []))
+
+                for id in files.get(_key(folder), []):
+
+                    try:
+                        stat = os.stat(id)
+
+                    except FileNotFoundError:
+                        continue
+
+                    self._check(id, os.path.basename(id), stat, root, index, found, unchanged)
+
+            else:
+
+                try:
+                    entries = os.scandir(folder)
+
+                #A subfolder can be deleted while we are scanning.
+                except FileNotFoundError:
+
+                    if folder == root:
+                        raise
+
+                    del folders[folder]
+                    continue
+
+                with entries:
+
+                    for entry in entries:
+
+                        #This intelligently joins the folder path and the file name into a filepath. It will use the right structure based on the OS the bot is running on.
+                        #We use the file path as the ID for local files as the file path must be unique.
+                        id = os.path.join(folder, entry.name)
+
+                        if entry.is_dir(follow_symlinks=False):
+                            stack.append((id, root))
+
+                        elif entry.is_file():
+                            self._check(id, entry.name, entry.stat(), root, index, found, unchanged)
+
+        #Working out what kind of file each new or modified file is means reading it, which we do on a pool of threads.
+        with ThreadPoolExecutor(self.bot.index_workers) as executor:
+
+            for (id, row), mimetype in zip(list(found.items()), executor.map(sniff, list(found))):
+
+                if mimetype is not None and mimetype.startswith(MEDIA_TYPES):
+                    row["MIMETYPE"] = mimetype
+
+                #Files that aren't media are left out of the database.
+                else:
+                    del found[id]
+
+        return found, unchanged, folders
+
+    #This function compares a file against the index, and adds it to the files that are either found (new or changed) or unchanged.
+    def _check(self, id, name, stat, root, index, found, unchanged):
+
+        version = "{}:{}".format(stat.st_size, stat.st_mtime_ns)
+
+        row = index.get(id)
+
+        if row is not None and row[2] == version and row[0] == name and row[4] == root:
+            unchanged.add(id)
+
+        else:
+            found[id] = {"NAME":name, "LOCATION":"LOCAL", "VERSION":version, "SIZE":stat.st_size, "MTIME":stat.st_mtime, "MIMETYPE":None, "HASH":None, "FOLDER":root}
+
+    #This function saves the modification times of the folders we scanned. It is called by updatedb, within its transaction.
+    def save(self, folders):
+
+        self.bot.cursor.execute("DELETE FROM '{}'".format(self.table))
+
+        self.bot.cursor.executemany("INSERT INTO '{}' VALUES (?, ?)".format(self.table), folders.items())
@@ -0,0 +1,195 @@
+import os
+
+import json
+
+import time
+
+import logging
+
+import threading
+
+#This class holds what we know about one run of a stage, such as a download or an upload.
+#The code being timed can set the number of bytes it transferred, and the outcome if it isn't simply "ok" or "error".
+class Stage:
+
+    def __init__(self, name):
+
+        self.name = name
+        self.bytes = 0
+        self.outcome = None
+        self.error = None
+
+#This class records the duration, bytes transferred, and outcome of each stage of a bot's work.
+#Every stage is logged as a JSON record and passed to any hooks as soon as it finishes, and flush() adds them to totals that are kept across runs and written out as a Prometheus textfile.
+class Metrics:
+
+    def __init__(self, bot, textfile=None, hooks=()):
+
+        self.bot = bot
+
+        #The path to write Prometheus metrics to, for example in the directory read by node_exporter's textfile collector.
+        self.textfile = textfile
+
+        #Each hook is called with the record of every stage as it finishes.
+        self.hooks = list(hooks)
+
+        #Records are logged as JSON by a child of the bot's logger, so they go to the same places as the bot's logs.
+        #The record is also attached to the log record as "metrics", for handlers that format their own JSON.
+        self.logger = logging.getLogger("{}.metrics".format(bot.name))
+
+        #Stages that have finished since the last flush. Stages can run on other threads, such as uploads, so this is guarded by a lock.
+        self.pending = []
+        self.lock = threading.Lock()
+
+    #This context manager times a stage, and records it as an error if an exception is raised from it.
+    def stage(self, name):
+        return _Timer(self, Stage(name))
+
+    #This function records a stage once it has finished.
+    def record(self, stage, duration):
+
+        record = {"bot":self.bot.name, "stage":stage.name, "duration":duration, "bytes":stage.bytes,
+                  "outcome":stage.outcome or ("error" if stage.error else "ok"), "error":stage.error, "time":time.time()}
+
+        with self.lock:
+            self.pending.append(record)
+
+        self.logger.info(json.dumps(record), extra={"metrics":record})
+
+        for hook in self.hooks:
+
+            #A broken hook must never stop the bot from posting.
+            try:
+                hook(record)
+
+            except Exception:
+                self.logger.exception("Metrics hook {} failed!".format(hook))
+
+        return record
+
+    #This function adds the stages since the last flush to the totals in the bot's state, and writes the textfile.
+    #It uses the bot's database connection, so it must be called from the thread that is running the bot.
+    def flush(self):
+
+        with self.lock:
+            pending, self.pending = self.pending, []
+
+        if not pending:
+            return
+
+        #For each stage, the number of runs with each outcome, the total duration and bytes, and the duration of the last run.
+        totals = json.loads(self.bot._getstate("metrics", "{}"))
+
+        for record in pending:
+
+            stage = totals.setdefault(record["stage"], {"outcomes":{}, "duration":0, "bytes":0, "last":0})
+
+            stage["outcomes"][record["outcome"]] = stage["outcomes"].get(record["outcome"], 0) + 1
+            stage["duration"] += record["duration"]
+            stage["bytes"] += record["bytes"]
+            stage["last"] = record["duration"]
+
+        with self.bot.connection:
+            self.bot._setstate("metrics", json.dumps(totals))
+
+        if self.textfile is not None:
+            self._write(totals)
+
+    #This function returns the totals in the Prometheus text format.
+    def export(self, totals=None):
+
+        if totals is None:
+            totals = json.loads(self.bot._getstate("metrics", "{}"))
+
+        bot = self.bot.name
+
+        lines = ["# HELP openmediabot_stage_total The number of times each stage has run, by outcome.",
+                 "# TYPE openmediabot_stage_total counter"]
+
+        for name, stage in sorted(totals.items()):
+            for outcome, count in sorted(stage["outcomes"].items()):
+                lines.append('openmediabot_stage_total{{bot="{}",stage="{}",outcome="{}"}} {}'.format(bot, name, outcome, count))
+
+        for metric, key, kind, description in (("openmediabot_stage_duration_seconds_total", "duration", "counter", "The total time spent in each stage."),
+                                               ("openmediabot_stage_bytes_total", "bytes", "counter", "The total bytes transferred by each stage."),
+                                               ("openmediabot_stage_last_duration_seconds", "last", "gauge", "The duration of the last run of each stage.")):
+
+            lines.append("# HELP {} {}".format(metric, description))
+            lines.append("# TYPE {} {}".format(metric, kind))
+
+            for name, stage in sorted(totals.items()):
+                lines.append('{}{{bot="{}",stage="{}"}} {}'.format(metric, bot, name, stage[key]))
+
+        return "\n".join(lines) + "\n"
+
+    def _write(self, totals):
+
+        #The textfile is written under a temporary name first, so it is never read half written.
+        with open(self.textfile + ".part", "w") as file:
+            file.write(self.export(totals))
+
+        os.replace(self.textfile + ".part", self.textfile)
+
+class _Timer:
+
+    def __init__(self, metrics, stage):
+        self.metrics = metrics
+        self.stage = stage
+
+    def __enter__(self):
+
+        self.start = time.perf_counter()
+
+        return self.stage
+
+    def __exit__(self, kind, error, traceback):
+
+        if error is not None:
+            self.stage.error = kind.__name__
+
+        self.metrics.record(self.stage, time.perf_counter() - self.start)
+
+#This class is used in place of Metrics when metrics are disabled, it does as little as possible.
+class NullMetrics:
+
+    def __init__(self):
+        self.hooks = []
+
+    def stage(self, name):
+        return _NULL_TIMER
+
+    def flush(self):
+        pass
+
+class _NullTimer:
+
+    #Anything the timed code sets on the stage is thrown away.
+    def __enter__(self):
+        return _NULL_STAGE
+
+    def __exit__(self, kind, error, traceback):
+        pass
+
+_NULL_STAGE = Stage(None)
+_NULL_TIMER = _NullTimer()
+
+#This function returns the size of a file-like object, without moving its position.
+def size(data):
+
+    position = data.tell()
+
+    data.seek(0, os.SEEK_END)
+    end = data.tell()
+
+    data.seek(position)
+
+    return end
+
+#This function passes chunks of data through, adding their size to the bytes of a stage.
+def counted(chunks, stage):
+
+    for chunk in chunks:
+
+        stage.bytes += len(chunk)
+
+        yield chunk
@@ -0,0 +1,201 @@
+import json
+
+import time
+
+#This class keeps posts that failed in the bot's database, so they can be tried again later instead of being dropped.
+#Each failed post is retried with exponential backoff, and never before the time a platform told us its rate limit resets.
+#Errors are also collected here, so admins can be sent one digest of everything that went wrong instead of a message for every error.
+class Outbox:
+
+    def __init__(self, bot, max_retries=5, initial_delay=60, max_delay=21600, clock=time.time):
+
+        #We use the bot's database connection and settings.
+        self.bot = bot
+
+        #The number of times a post is retried before we give up on it.
+        self.max_retries = max_retries
+
+        #The number of seconds to wait before the first retry, this doubles for every retry after it, up to "max_delay".
+        self.initial_delay = initial_delay
+        self.max_delay = max_delay
+
+        self.clock = clock
+
+        self.table = "{}_OUTBOX".format(bot.name)
+        self.errors = "{}_ERRORS".format(bot.name)
+
+        with bot.connection:
+
+            #Each entry is a post that failed, with the IDs of its media (as a JSON list) and its status, the class and message of its last error, and when to try it again.
+            bot.cursor.execute("""CREATE TABLE IF NOT EXISTS '{}' (
+            ENTRY integer PRIMARY KEY,
+            IDS text NOT NULL,
+            STATUS text,
+            ERROR text NOT NULL,
+            MESSAGE text,
+            ATTEMPTS integer NOT NULL,
+            NEXT real NOT NULL);""".format(self.table))
+
+            #This index allows us to find the next post that is due quickly.
+            bot.cursor.execute("CREATE INDEX IF NOT EXISTS '{0}_NEXT' ON '{0}' (NEXT);".format(self.table))
+
+            #These are the errors that haven't been sent to admins yet, and whether we gave up on the post because of them.
+            bot.cursor.execute("""CREATE TABLE IF NOT EXISTS '{}' (
+            TIME real NOT NULL,
+            IDS text NOT NULL,
+            ERROR text NOT NULL,
+            MESSAGE text,
+            GAVE_UP BOOLEAN NOT NULL);""".format(self.errors))
+
+    #This function returns the number of posts waiting to be retried.
+    def __len__(self):
+
+        self.bot.cursor.execute("SELECT COUNT(*) FROM '{}'".format(self.table))
+
+        return self.bot.cursor.fetchone()[0]
+
+    #This function returns the IDs of all of the media waiting to be retried.
+    def ids(self):
+
+        self.bot.cursor.execute("SELECT IDS FROM '{}'".format(self.table))
+
+        return {id for row in self.bot.cursor.fetchall() for id in json.loads(row[0])}
+
+    #This function records that a post failed with the given exception.
+    #"entry" is the outbox entry the post came from, if it was a retry, and "retry_at" is the earliest time it may be tried again, such as when a rate limit resets.
+    #It returns True if the post will be retried, or False if we have given up on it.
+    def failed(self, ids, status, error, entry=None, retry_at=None):
+
+        cursor = self.bot.cursor
+
+        now = self.clock()
+
+        attempts = 0
+
+        #If the same media is already waiting to be retried, that entry is updated, so it keeps its attempts instead of starting over.
+        if entry is None:
+            cursor.execute("SELECT ENTRY FROM '{}' WHERE IDS=:IDS".format(self.table), {"IDS":json.dumps(list(ids))})
+            row = cursor.fetchone()
+            entry = row[0] if row is not None else None
+
+        if entry is not None:
+            cursor.execute("SELECT ATTEMPTS FROM '{}' WHERE ENTRY=:ENTRY".format(self.table), {"ENTRY":entry})
+            row = cursor.fetchone()
+            attempts = row[0] if row is not None else 0
+
+        attempts += 1
+
+        row = {"ENTRY":entry, "IDS":json.dumps(list(ids)), "STATUS":status, "ERROR":type(error).__name__, "MESSAGE":str(error), "ATTEMPTS":attempts,
+               "NEXT":max(now + min(self.initial_delay * 2 ** (attempts - 1), self.max_delay), retry_at or 0)}
+
+        retry = attempts <= self.max_retries
+
+        with self.bot.connection:
+
+            if retry:
+                cursor.execute("INSERT OR REPLACE INTO '{}' VALUES (:ENTRY, :IDS, :STATUS, :ERROR, :MESSAGE, :ATTEMPTS, :NEXT)".format(self.table), row)
+
+            elif entry is not None:
+                cursor.execute("DELETE FROM '{}' WHERE ENTRY=:ENTRY".format(self.table), {"ENTRY":entry})
+
+            cursor.execute("INSERT INTO '{}' VALUES (:TIME, :IDS, :ERROR, :MESSAGE, :GAVE_UP)".format(self.errors),
+            {"TIME":now, "IDS":row["IDS"], "ERROR":row["ERROR"], "MESSAGE":row["MESSAGE"], "GAVE_UP":not retry})
+
+        if retry:
+            self.bot.logger.info("Will retry {} in {} seconds (attempt {} of {}).".format(", ".join(ids), round(row["NEXT"] - now), attempts, self.max_retries))
+        else:
+            self.bot.logger.info("Giving up on {} after {} retries.".format(", ".join(ids), self.max_retries))
+
+        return retry
+
+    #This function returns the next post that is due to be retried, as a tuple of its entry, a list of its media, and its status, or None if nothing is due.
+    #Posts whose media have been deleted from the database, or have all been posted since, are dropped.
+    def take(self, no_repeat=True):
+
+        cursor = self.bot.cursor
+
+        while True:
+
+            cursor.execute("SELECT ENTRY, IDS, STATUS FROM '{}' WHERE NEXT<=:NOW ORDER BY NEXT LIMIT 1".format(self.table), {"NOW":self.clock()})
+            row = cursor.fetchone()
+
+            if row is None:
+                return None
+
+            entry, ids, status = row[0], json.loads(row[1]), row[2]
+
+            rows = []
+
+            for id in ids:
+                cursor.execute("SELECT ID, NAME, LOCATION, VERSION, MIMETYPE, POSTED FROM '{}' WHERE ID=:ID".format(self.bot.name), {"ID":id})
+                rows.append(cursor.fetchone())
+
+            if None in rows or (no_repeat and all(row[5] for row in rows)):
+                self.bot.logger.info("Dropping retry of {}, as it has been deleted or posted.".format(", ".join(ids)))
+                self.done(entry)
+                continue
+
+            self.bot.logger.info("Retrying {}...".format(", ".join(ids)))
+
+            return entry, [self.bot._open(*row[:5]) for row in rows], status
+
+    #This function removes a post from the outbox, once it has been posted.
+    def done(self, entry):
+
+        with self.bot.connection:
+            self.bot.cursor.execute("DELETE FROM '{}' WHERE ENTRY=:ENTRY".format(self.table), {"ENTRY":entry})
+
+    #This function records that the platform won't accept any more posts until the given time.
+    def rate_limit(self, until):
+
+        with self.bot.connection:
+            self.bot._setstate("rate_limit_reset", until)
+
+        self.bot.logger.info("Rate limited until {}.".format(time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(until))))
+
+    #This function returns the number of seconds until the rate limit resets, or 0 if we aren't rate limited.
+    def limited(self):
+        return max(0, float(self.bot._getstate("rate_limit_reset", 0)) - self.clock())
+
+    #This function returns a digest of the errors that haven't been sent yet, or None if there are none, or if the last digest was sent less than "interval" seconds ago.
+    def digest(self, interval):
+
+        cursor = self.bot.cursor
+
+        if self.clock() - float(self.bot._getstate("last_digest", 0)) < interval:
+            return None
+
+        cursor.execute("SELECT ERROR, COUNT(*), MAX(TIME), MIN(TIME) FROM '{}' GROUP BY ERROR ORDER BY COUNT(*) DESC".format(self.errors))
+        counts = cursor.fetchall()
+
+        if not counts:
+            return None
+
+        lines = ["{} error(s) since {}:".format(sum(row[1] for row in counts), time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(min(row[3] for row in counts))))]
+
+        #For each kind of error, we include how many times it happened, and the most recent message.
+        for error, count, latest, earliest in counts:
+
+            cursor.execute("SELECT MESSAGE FROM '{}' WHERE ERROR=:ERROR ORDER BY TIME DESC LIMIT 1".format(self.errors), {"ERROR":error})
+
+            lines.append(" {} x{}: {}".format(error, count, cursor.fetchone()[0]))
+
+        cursor.execute("SELECT IDS FROM '{}' WHERE GAVE_UP".format(self.errors))
+        gave_up = [id for row in cursor.fetchall() for id in json.loads(row[0])]
+
+        if gave_up:
+            lines.append("Gave up on: {}".format(", ".join(gave_up)))
+
+        lines.append("{} post(s) waiting to be retried.".format(len(self)))
+
+        #Direct messages are limited to 10000 characters.
+        return "\n".join(lines)[:10000]
+
+    #This function clears the errors that were sent in a digest.
+    def sent(self):
+
+        with self.bot.connection:
+
+            self.bot.cursor.execute("DELETE FROM '{}'".format(self.errors))
+
+            self.bot._setstate("last_digest", self.clock())
@@ -0,0 +1,185 @@
+import os
+
+import json
+
+import hashlib
+
+import threading
+
+from .bot import Media
+
+#This class picks the media for the next post ahead of time, and downloads it on a background thread while the bot does other things.
+#The staged media is recorded in the bot's state, so a bot that is run again later (by cron, for example) can pick up where the last run left off.
+class Prefetcher:
+
+    def __init__(self, bot):
+
+        #We use the bot's database connection and settings.
+        self.bot = bot
+
+        #Each bot gets its own folder in the staging area, since it is cleared out whenever something new is staged.
+        self.directory = os.path.join(bot.staging_dir, bot.name)
+
+        os.makedirs(self.directory, exist_ok=True)
+
+        #The thread that is downloading the staged media, if there is one.
+        self.thread = None
+
+    #This function picks the media for the next post, and starts getting it ready on a background thread.
+    #Files in "exclude" are never picked, such as the file that is being posted right now.
+    #If "reset" is False and everything has been posted, the database isn't reset and nothing is staged.
+    def start(self, no_repeat=True, exclude=(), reset=True):
+
+        #Only one file is staged at a time, so we let any download in progress finish before replacing it.
+        self.wait()
+
+        #Anything left in the staging area is from a post that has already been made.
+        self._clean()
+
+        #If there is nothing else to pick, such as when everything that hasn't been posted is waiting in the outbox, nothing is staged.
+        try:
+            row = self.bot._select(no_repeat, exclude, reset)
+
+        except IndexError:
+            self.bot.logger.info("Nothing to prefetch.")
+            return
+
+        if row is None:
+            return
+
+        id, name, location, version, mimetype = row
+
+        #Files are named by a hash of their ID, since Drive IDs aren't guaranteed to be valid file names everywhere.
+        path = os.path.join(self.directory, hashlib.sha1(id.encode()).hexdigest())
+
+        #A Drive file that is already in the media cache doesn't need to be downloaded again.
+        #This is checked here rather than on the background thread, since the cache's index is in the database.
+        cached = None
+
+        if location == "DRIVE" and self.bot.cache is not None:
+            cached = self.bot.cache.path(id, version)
+
+        with self.bot.connection:
+            self.bot._setstate("staged", json.dumps({"id":id, "name":name, "location":location, "version":version, "mimetype":mimetype, "path":path, "cached":cached is not None}))
+
+        self.bot.logger.info("STAGED: {} ({})".format(name, id))
+
+        #This is not a daemon thread, so a bot that exits right after posting will still finish the download first.
+        self.thread = threading.Thread(target=self._stage, args=(id, location, mimetype, path, cached), name="{}-prefetch".format(self.bot.name))
+        self.thread.start()
+
+    #This function runs on the background thread. It downloads Drive files into the staging area, then lets the bot do any processing it needs.
+    #It doesn't touch the database, since the bot's connection can only be used from the thread that created it.
+    #If the file is in the media cache, "cached" is its path there.
+    def _stage(self, id, location, mimetype, path, cached=None):
+
+        try:
+            #Local and cached files don't need to be downloaded.
+            if location == "LOCAL":
+                self.bot._prestage(id, mimetype)
+                return
+
+            if cached is not None:
+                self.bot._prestage(cached, mimetype)
+                return
+
+            from .metrics import counted
+
+            with self.bot.metrics.stage("prefetch") as stage:
+
+                file, chunks = self.bot.drive_client.open_file(id)
+
+                #We download to temporary names first, the file is only considered staged once its metadata has been written.
+                with open(path + ".part", "wb") as staged:
+                    for chunk in counted(chunks, stage):
+                        staged.write(chunk)
+
+            os.replace(path + ".part", path)
+
+            self.bot._prestage(path, file['mimeType'])
+
+            with open(path + ".json.part", "w") as metadata:
+                json.dump({"mimetype":file['mimeType']}, metadata)
+
+            os.replace(path + ".json.part", path + ".json")
+
+            self.bot.logger.info("PREFETCHED: {} ({})".format(file['title'], id))
+
+        #If the download fails, the staged media is simply never used.
+        except Exception:
+            self.bot.logger.exception("Unable to prefetch {}!".format(id))
+
+    #This function waits for the staged media to finish downloading.
+    def wait(self):
+
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    #This function returns a media object for the staged media and clears it, or returns None if nothing usable is staged.
+    def take(self, no_repeat=True):
+
+        self.wait()
+
+        staged = self.bot._getstate("staged")
+
+        if staged is None:
+            return None
+
+        staged = json.loads(staged)
+
+        self.clear()
+
+        #Make sure the staged file still exists in our database, and hasn't been renamed, modified, or posted since it was staged.
+        self.bot.cursor.execute("SELECT NAME, VERSION, POSTED FROM '{}' WHERE ID=:ID".format(self.bot.name), {"ID":staged["id"]})
+        row = self.bot.cursor.fetchone()
+
+        if row is None or row[0] != staged["name"] or row[1] != staged["version"] or (no_repeat and row[2]):
+            self.bot.logger.info("Staged media {} is no longer valid!".format(staged["id"]))
+            return None
+
+        self.bot.logger.info("Selected {} ({})!".format(staged["name"], staged["id"]))
+
+        if staged["location"] == "LOCAL":
+            return self.bot._open(staged["id"], staged["name"], staged["location"], staged["version"], staged["mimetype"])
+
+        #If the file was in the media cache, it is taken from there. It may have been removed from the cache since, in which case we will have to select something else.
+        if staged.get("cached"):
+            return self.bot.cache.get(staged["id"], staged["version"], staged["name"])
+
+        #If the download didn't finish, we will have to select something else.
+        if not os.path.exists(staged["path"] + ".json"):
+            self.bot.logger.info("Staged media {} was not downloaded!".format(staged["id"]))
+            return None
+
+        with open(staged["path"] + ".json") as metadata:
+            mimetype = json.load(metadata)["mimetype"]
+
+        #The download is kept in the media cache, so it won't have to be downloaded again the next time it is picked.
+        if self.bot.cache is not None:
+            return self.bot.cache.adopt(staged["id"], staged["version"], staged["name"], mimetype, staged["path"])
+
+        return Media(open(staged["path"], "rb"), mimetype, staged["name"], staged["id"])
+
+    #This function forgets the staged media. Its files are removed the next time something is staged.
+    def clear(self):
+
+        with self.bot.connection:
+            self._forget()
+
+    #This function forgets the staged media if it was modified or deleted. It is called by updatedb, within its transaction.
+    def invalidate(self, ids):
+
+        staged = self.bot._getstate("staged")
+
+        if staged is not None and json.loads(staged)["id"] in ids:
+            self._forget()
+
+    def _forget(self):
+        self.bot.cursor.execute("DELETE FROM OMB_STATE WHERE BOT=:BOT AND KEY='staged'", {"BOT":self.bot.name})
+
+    #This function removes everything from the staging area.
+    def _clean(self):
+
+        for file in os.listdir(self.directory):
+            os.remove(os.path.join(self.directory, file))
@@ -0,0 +1,136 @@
+import os
+
+import hashlib
+
+import threading
+
+from io import BytesIO
+
+#These are the largest image, in bytes and pixels, that we will upload.
+#They match Twitter's limits for photos.
+MAX_SIZE = 5242880
+MAX_DIMENSION = 4096
+
+#These are the image formats that can be uploaded without being converted.
+FORMATS = ("JPEG", "PNG", "WEBP")
+
+#This function makes sure that an image can be uploaded.
+#If the image is already within our limits, it returns None and the image can be uploaded as it is.
+#Otherwise, it returns the path to a smaller copy of the image (a derivative) which is within our limits.
+#Derivatives are stored in the given directory, named by a hash of the original image and the limits it was made for, so each image only ever has to be converted once, and is converted again if the limits change.
+#The source can be either a path or a file-like object. It can be run on several threads at once, as Pillow releases the GIL while it decodes and encodes images.
+def prepare(source, directory, max_size=MAX_SIZE, max_dimension=MAX_DIMENSION):
+
+    from PIL import Image
+
+    #Opening an image only reads its header, so checking it is cheap.
+    with Image.open(_rewind(source)) as im:
+
+        #GIFs may be animated, converting them would lose the animation, so they are always uploaded as they are.
+        if im.format == "GIF":
+            return None
+
+        if _size(source) <= max_size and im.format in FORMATS and max(im.size) <= max_dimension:
+            return None
+
+    name = "{}-{}-{}".format(_hash(source), max_size, max_dimension)
+
+    for extension in (".png", ".jpg"):
+
+        path = os.path.join(directory, name + extension)
+
+        if os.path.exists(path):
+            return path
+
+    with Image.open(_rewind(source)) as im:
+        data, extension = _derive(im, max_size, max_dimension)
+
+    os.makedirs(directory, exist_ok=True)
+
+    path = os.path.join(directory, name + extension)
+
+    #We write to a temporary name first, so that a partial file is never mistaken for a finished derivative.
+    #Each thread has its own temporary name, since two threads can be preparing copies of the same image.
+    part = "{}.{}.part".format(path, threading.get_ident())
+
+    with open(part, "wb") as file:
+        file.write(data)
+
+    os.replace(part, path)
+
+    return path
+
+#This function shrinks an image until it fits in our limits, and returns its data along with the file extension to use.
+def _derive(im, max_size, max_dimension):
+
+    im.load()
+
+    #Scale the image down if it is too large. This keeps the aspect ratio.
+    if max(im.size) > max_dimension:
+        im.thumbnail((max_dimension, max_dimension))
+
+    #Images with transparency, and PNGs in general, are best kept as PNGs if they will fit.
+    if im.format == "PNG" or im.mode in ("RGBA", "LA", "P"):
+
+        data = _save(im, "PNG", optimize=True)
+
+        if len(data) <= max_size:
+            return data, ".png"
+
+        #Reducing the image to a palette of 256 colors normally doesn't have an effect on quality (for anime images, for example), and makes the file a lot smaller.
+        data = _save(im.convert("RGBA").quantize(256), "PNG", optimize=True)
+
+        if len(data) <= max_size:
+            return data, ".png"
+
+    im = im.convert("RGB")
+
+    #Try lower and lower quality JPEGs, and if none of them fit, scale the image down and try again.
+    while True:
+
+        for quality in (95, 85, 75, 60):
+
+            data = _save(im, "JPEG", quality=quality, optimize=True)
+
+            if len(data) <= max_size:
+                return data, ".jpg"
+
+        im = im.resize((max(1, im.width * 3 // 4), max(1, im.height * 3 // 4)))
+
+def _save(im, format, **kwargs):
+
+    with BytesIO() as data:
+        im.save(data, format=format, **kwargs)
+        return data.getvalue()
+
+#These functions allow us to treat paths and file-like objects the same way.
+def _rewind(source):
+
+    if not isinstance(source, str):
+        source.seek(0)
+
+    return source
+
+def _size(source):
+
+    if isinstance(source, str):
+        return os.path.getsize(source)
+
+    source.seek(0, os.SEEK_END)
+    return source.tell()
+
+def _hash(source):
+
+    digest = hashlib.sha256()
+
+    if isinstance(source, str):
+        with open(source, "rb") as file:
+            for chunk in iter(lambda: file.read(1048576), b""):
+                digest.update(chunk)
+
+    else:
+        _rewind(source)
+        for chunk in iter(lambda: source.read(1048576), b""):
+            digest.update(chunk)
+
+    return digest.hexdigest()
@@ -0,0 +1,115 @@
+import time
+
+import threading
+
+from concurrent.futures import Future
+
+#This exception is raised when a platform fails to process uploaded media, or takes too long to do so.
+class ProcessingError(Exception):
+    pass
+
+#This class keeps track of media that is being processed after it was uploaded, such as a video that Twitter is transcoding.
+#It polls the status of the media, waiting as long as the server asks between each check, and backing off exponentially when it doesn't say or when nothing changes.
+#The "status" argument is a function which takes a media ID and returns the server's response, so the tracker can be used with a fake upload endpoint for testing.
+class ProcessingTracker:
+
+    def __init__(self, status, media_id, response, initial_delay=1, max_delay=60, timeout=600, sleep=time.sleep, clock=time.monotonic):
+
+        self.status = status
+        self.media_id = media_id
+
+        #This is the latest response from the server.
+        self.response = response
+
+        self.initial_delay = initial_delay
+        self.max_delay = max_delay
+        self.timeout = timeout
+
+        self.sleep = sleep
+        self.clock = clock
+
+        self.started = clock()
+
+        #The number of checks in a row where the progress of the media has not changed.
+        self.stalled = 0
+
+    #This returns the processing state of the media, or None if the media does not need processing.
+    @property
+    def state(self):
+        return (self.response.get('processing_info') or {}).get('state')
+
+    #This function checks the latest response, and returns how many seconds to wait before the next check, or None if the media is ready.
+    #It raises a ProcessingError if processing failed, or if it has taken longer than the timeout.
+    def poll(self):
+
+        info = self.response.get('processing_info') or {}
+
+        state = info.get('state')
+
+        #Media that doesn't need processing has no processing info.
+        if state is None or state == 'succeeded':
+            return None
+
+        if state == 'failed':
+            error = info.get('error', {})
+            raise ProcessingError("Processing of media {} failed: {}".format(self.media_id, error.get('message', error.get('name', 'unknown error'))))
+
+        if self.clock() - self.started > self.timeout:
+            raise ProcessingError("Processing of media {} did not finish within {} seconds.".format(self.media_id, self.timeout))
+
+        #Wait at least as long as the server asked us to, and back off further for every check that makes no progress.
+        backoff = min(self.initial_delay * 2 ** self.stalled, self.max_delay)
+
+        return max(info.get('check_after_secs', 0), backoff)
+
+    #This function fetches the latest status of the media from the server.
+    def refresh(self):
+
+        progress = (self.response.get('processing_info') or {}).get('progress_percent')
+
+        self.response = self.status(self.media_id)
+
+        if (self.response.get('processing_info') or {}).get('progress_percent') == progress:
+            self.stalled += 1
+        else:
+            self.stalled = 0
+
+    #This function blocks until the media is ready, and returns the server's final response.
+    def wait(self):
+
+        delay = self.poll()
+
+        while delay is not None:
+
+            self.sleep(delay)
+
+            self.refresh()
+
+            delay = self.poll()
+
+        return self.response
+
+    #This function waits for the media on another thread, so the caller can do other work in the meantime.
+    #The wait is run on the given executor if there is one, otherwise on a new thread.
+    #It returns a Future for the server's final response, and calls the callback (if given) with the Future once it is done.
+    def start(self, executor=None, callback=None):
+
+        if executor is not None:
+            future = executor.submit(self.wait)
+
+        else:
+            future = Future()
+
+            def run():
+                if future.set_running_or_notify_cancel():
+                    try:
+                        future.set_result(self.wait())
+                    except Exception as e:
+                        future.set_exception(e)
+
+            threading.Thread(target=run, name="processing-{}".format(self.media_id), daemon=True).start()
+
+        if callback is not None:
+            future.add_done_callback(callback)
+
+        return future
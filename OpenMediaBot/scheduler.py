@@ -0,0 +1,207 @@
+import sqlite3
+
+import logging
+
+import json
+
+import time
+
+import queue
+
+import threading
+
+from contextlib import contextmanager
+
+#This class hands out SQLite connections to bots that share a database file, so that many bots can run in one process.
+#Connections are opened in WAL mode, which lets bots read while another bot is writing, and wait for the write lock instead of failing.
+class ConnectionPool:
+
+    def __init__(self, size=4, timeout=30):
+
+        #The maximum number of connections to open for each database file.
+        self.size = size
+
+        #How long, in seconds, a connection will wait for another to release the write lock.
+        self.timeout = timeout
+
+        #For each database file, a queue of idle connections and the number of connections opened so far.
+        self.idle = {}
+        self.opened = {}
+
+        self.lock = threading.Lock()
+
+    def _connect(self, db):
+
+        #Connections are handed between threads, but are only ever used by one thread at a time.
+        connection = sqlite3.connect(db, timeout=self.timeout, check_same_thread=False)
+
+        connection.execute("PRAGMA journal_mode=WAL")
+
+        #With WAL, this is still safe against corruption, and avoids waiting on the disk after every transaction.
+        connection.execute("PRAGMA synchronous=NORMAL")
+
+        return connection
+
+    #This function lends a connection for the given database file, blocking until one is free.
+    @contextmanager
+    def connection(self, db):
+
+        with self.lock:
+
+            idle = self.idle.setdefault(db, queue.Queue())
+
+            #Every connection to an in-memory database is a different database, so those can only have one connection.
+            size = 1 if db == ":memory:" else self.size
+
+            if idle.empty() and self.opened.get(db, 0) < size:
+                self.opened[db] = self.opened.get(db, 0) + 1
+                idle.put(self._connect(db))
+
+        connection = idle.get()
+
+        try:
+            yield connection
+
+        finally:
+            idle.put(connection)
+
+#This class runs many bots in one long-running process, each on its own interval.
+#Bots are run on a bounded pool of threads, so one bot can upload while another downloads, and a bot that fails or hangs doesn't hold up the others.
+class Scheduler:
+
+    def __init__(self, workers=4, pool=None):
+
+        self.workers = workers
+
+        #All bots share one pool of database connections.
+        self.pool = pool if pool is not None else ConnectionPool(workers)
+
+        #Each job is a dictionary holding a bot, its interval, the function to run, and when to run it next.
+        self.jobs = []
+
+        self.logger = logging.getLogger("OpenMediaBot.scheduler")
+
+        #This is set to stop the scheduler.
+        self.stopped = threading.Event()
+
+    #This function creates a bot and schedules it to run every "interval" seconds.
+    #The "action" is the name of the bot method to run, by default bots post, or update their database if they can't post.
+    #Any other keyword arguments are passed to the bot.
+    def add(self, bot_class=None, interval=3600, action=None, **kwargs):
+
+        if bot_class is None:
+            from .twitter_bot import TwitterBot
+            bot_class = TwitterBot
+
+        db = kwargs.get("db", "media.db")
+
+        #The bot's configuration file overrides its keyword arguments, so we look for its database file there too.
+        if kwargs.get("configfile") is not None:
+
+            with open(kwargs["configfile"]) as jsonfile:
+                db = json.load(jsonfile).get("db", db)
+
+        #The bot is created with a connection from the pool, which it gives back once it is set up.
+        with self.pool.connection(db) as connection:
+            bot = bot_class(connection=connection, **kwargs)
+
+        if action is None:
+            action = "post" if hasattr(bot, "post") else "updatedb"
+
+        self.jobs.append({"bot":bot, "interval":interval, "action":getattr(bot, action), "next":time.monotonic(), "future":None})
+
+        return bot
+
+    #This function schedules a bot from a JSON configuration file.
+    #Along with the bot's usual configuration options, the file may contain "class" ("TwitterBot" or "Bot"), "interval" in seconds, "action", and "twitter_credfile".
+    def load(self, configfile):
+
+        from . import bot as bot_module, twitter_bot
+
+        with open(configfile) as jsonfile:
+            config = json.load(jsonfile)
+
+        classes = {"Bot":bot_module.Bot, "TwitterBot":twitter_bot.TwitterBot}
+
+        kwargs = {}
+
+        if "twitter_credfile" in config:
+            kwargs["twitter_credfile"] = config["twitter_credfile"]
+
+        return self.add(classes[config.get("class", "TwitterBot")], config.get("interval", 3600), config.get("action"), configfile=configfile, **kwargs)
+
+    #This function runs a job with a connection from the pool.
+    def _run(self, job):
+
+        bot = job["bot"]
+
+        try:
+            with self.pool.connection(bot.db) as connection:
+                bot._bind(connection)
+                job["action"]()
+
+        #One bot failing must never stop the others.
+        except Exception:
+            bot.logger.exception("An error has occured!")
+
+    #This function runs the scheduled bots until stop() is called.
+    def run(self):
+
+        from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+        self.logger.info("Running {} bots on {} workers...".format(len(self.jobs), self.workers))
+
+        with ThreadPoolExecutor(self.workers, thread_name_prefix="OpenMediaBot") as executor:
+
+            while not self.stopped.is_set():
+
+                now = time.monotonic()
+
+                for job in self.jobs:
+
+                    #A bot that is still running is not started again, it will run once it has finished.
+                    if job["future"] is not None and not job["future"].done():
+                        continue
+
+                    if job["next"] <= now:
+                        job["next"] = now + job["interval"]
+                        job["future"] = executor.submit(self._run, job)
+
+                #Sleep until the next bot is due, or a bot finishes, or we are stopped.
+                #A bot that is still running can't be due, even if it has run past its interval, otherwise we would never sleep until it finished.
+                running = [job["future"] for job in self.jobs if job["future"] is not None and not job["future"].done()]
+                delay = max(0, min([job["next"] for job in self.jobs if job["future"] not in running], default=now + 1) - time.monotonic())
+
+                if running:
+                    wait(running, timeout=min(delay, 1), return_when=FIRST_COMPLETED)
+                else:
+                    self.stopped.wait(min(delay, 1))
+
+    #This function stops the scheduler once the bots that are running have finished.
+    def stop(self):
+        self.stopped.set()
+
+#This allows the scheduler to be run with "python -m OpenMediaBot.scheduler config.json [config.json ...]".
+def main(args=None):
+
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Run many OpenMediaBot bots in one process.")
+    parser.add_argument("configfiles", nargs="+", help="JSON configuration files, one for each bot.")
+    parser.add_argument("--workers", type=int, default=4, help="The number of bots that can run at the same time.")
+
+    args = parser.parse_args(args)
+
+    scheduler = Scheduler(args.workers)
+
+    for configfile in args.configfiles:
+        scheduler.load(configfile)
+
+    try:
+        scheduler.run()
+
+    except KeyboardInterrupt:
+        scheduler.stop()
+
+if __name__ == "__main__":
+    main()
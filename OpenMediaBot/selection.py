@@ -0,0 +1,445 @@
+import time
+
+import uuid
+
+import random
+
+#These are the columns of each file that are given to selection strategies.
+COLUMNS = ("ID", "NAME", "LOCATION", "MIMETYPE", "FOLDER", "PRIORITY", "LAST_POSTED", "POSTED")
+
+#This class is the base for selection strategies, which decide how likely each file is to be picked.
+#Files are put into groups (such as the folder they are in), a group is picked using its weight, then a file is picked from that group using the weights of its files.
+#Every strategy multiplies the weight of a file by its priority, so files can be boosted or held back with Bot.prioritize().
+class SelectionStrategy:
+
+    #This function returns the weight of a file, given a dictionary of its COLUMNS. A file with a weight of 0 is never picked.
+    def weight(self, row):
+        return 1 if row["PRIORITY"] is None else row["PRIORITY"]
+
+    #This function returns the group a file is in. By default, all files are in the same group.
+    def group(self, row):
+        return None
+
+    #This function returns the weight of a group.
+    def group_weight(self, group):
+        return 1
+
+    #This function is called before the weights of every file are worked out.
+    def prepare(self):
+        pass
+
+    #This function returns True if the weights that were worked out have to be worked out again, for strategies whose weights change over time.
+    def stale(self):
+        return False
+
+#Every file is as likely to be picked as any other, apart from their priorities.
+class Uniform(SelectionStrategy):
+    pass
+
+#Each folder is picked using its weight, then a file is picked from that folder, so a folder with only a few files is picked as often as one with thousands.
+#The weights are a dictionary from folder (a Drive folder ID, or a path as it is given in "local_folders") to weight, folders that aren't in it have a weight of 1.
+class FolderWeighted(SelectionStrategy):
+
+    def __init__(self, weights=None):
+        self.weights = weights or {}
+
+    def group(self, row):
+        return row["FOLDER"]
+
+    def group_weight(self, group):
+        return self.weights.get(group, 1)
+
+#Files that were posted longer ago are more likely to be picked. A file's weight doubles for every "halflife" seconds since it was last posted.
+#Files that have never been posted count as having been posted 32 half-lives ago, which is as far back as the weights go.
+#The weights of files don't change as time passes, only the weight of a file that is posted does. Since doubling every weight doesn't change the odds, each file's weight is worked out relative to a reference time, and once that time is 32 half-lives old all of the weights are worked out again.
+class LeastRecentlyPosted(SelectionStrategy):
+
+    #The number of half-lives that weights are kept within.
+    LIMIT = 32
+
+    def __init__(self, halflife=604800, clock=time.time):
+
+        self.halflife = halflife
+        self.clock = clock
+
+        self.reference = clock()
+
+    def weight(self, row):
+
+        if row["LAST_POSTED"] is None:
+            age = self.LIMIT
+        else:
+            age = max(-self.LIMIT, min((self.reference - row["LAST_POSTED"]) / self.halflife, self.LIMIT))
+
+        return super().weight(row) * 2.0 ** age
+
+    def prepare(self):
+        self.reference = self.clock()
+
+    def stale(self):
+        return self.clock() - self.reference > self.LIMIT * self.halflife
+
+#These are the strategies that can be chosen by name, with the "selection" option.
+STRATEGIES = {"uniform":Uniform, "folder":FolderWeighted, "least_recently_posted":LeastRecentlyPosted}
+
+#This function returns the strategy to use given either its name, or a SelectionStrategy.
+def strategy(selection, **options):
+
+    if isinstance(selection, SelectionStrategy):
+        return selection
+
+    if selection not in STRATEGIES:
+        raise ValueError("Unknown selection strategy {}. The built in strategies are: {}.".format(selection, ", ".join(STRATEGIES)))
+
+    return STRATEGIES[selection](**options)
+
+#This class is a set of keys with weights, which can pick a random key in proportion to its weight in O(log n) time.
+#The weights are kept in a Fenwick tree, so changing the weight of a key, adding a key, or removing one also takes O(log n) time.
+class WeightedSet:
+
+    def __init__(self, items=()):
+
+        #Each key is kept in a slot, slots of removed keys are reused by new ones.
+        self.keys = []
+        self.weights = []
+        self.slots = {}
+        self.free = []
+
+        #The number of keys with a weight above 0.
+        self.positive = 0
+
+        for key, weight in items:
+            self.slots[key] = len(self.keys)
+            self.keys.append(key)
+            self.weights.append(weight)
+            self.positive += weight > 0
+
+        self._build(max(1, len(self.keys)))
+
+    #This function builds the tree from the weights of each slot in O(n) time.
+    def _build(self, capacity):
+
+        self.capacity = capacity
+
+        self.tree = [0.0] * (capacity + 1)
+
+        for i, weight in enumerate(self.weights, 1):
+
+            self.tree[i] += weight
+
+            parent = i + (i & -i)
+
+            if parent <= capacity:
+                self.tree[parent] += self.tree[i]
+
+    def _add(self, slot, delta):
+
+        i = slot + 1
+
+        while i <= self.capacity:
+            self.tree[i] += delta
+            i += i & -i
+
+    def __len__(self):
+        return len(self.slots)
+
+    def __contains__(self, key):
+        return key in self.slots
+
+    def weight(self, key):
+        return self.weights[self.slots[key]] if key in self.slots else 0
+
+    #The sum of every weight, which is read from the tree so it always agrees with pick().
+    @property
+    def total(self):
+
+        total = 0.0
+
+        i = self.capacity
+
+        while i > 0:
+            total += self.tree[i]
+            i -= i & -i
+
+        return total
+
+    #This function adds a key, or changes its weight.
+    def set(self, key, weight):
+
+        slot = self.slots.get(key)
+
+        if slot is None:
+
+            if self.free:
+                slot = self.free.pop()
+                self.keys[slot] = key
+                self.weights[slot] = 0
+
+            else:
+                slot = len(self.keys)
+                self.keys.append(key)
+                self.weights.append(0)
+
+                #When the tree is full, it is rebuilt with twice the room, so adding keys takes O(log n) time on average.
+                if slot >= self.capacity:
+                    self._build(self.capacity * 2)
+
+            self.slots[key] = slot
+
+        self.positive += (weight > 0) - (self.weights[slot] > 0)
+
+        self._add(slot, weight - self.weights[slot])
+        self.weights[slot] = weight
+
+    def discard(self, key):
+
+        slot = self.slots.pop(key, None)
+
+        if slot is None:
+            return
+
+        self.positive -= self.weights[slot] > 0
+
+        self._add(slot, -self.weights[slot])
+
+        self.keys[slot] = None
+        self.weights[slot] = 0
+
+        self.free.append(slot)
+
+    #This function picks a random key in proportion to its weight. It raises an IndexError if every weight is 0.
+    def pick(self, rng=random):
+
+        total = self.total
+
+        if total <= 0:
+            raise IndexError("There are no keys with a weight above 0.")
+
+        #Rounding errors in the tree can very rarely land us on an empty slot, in which case we pick again.
+        for attempt in range(8):
+
+            value = rng.random() * total
+
+            #Walk down the tree to find the first slot where the running total of the weights passes the value.
+            slot = 0
+            step = 1 << self.capacity.bit_length()
+
+            while step:
+
+                i = slot + step
+
+                if i <= self.capacity and self.tree[i] <= value:
+                    slot = i
+                    value -= self.tree[i]
+
+                step >>= 1
+
+            if slot < len(self.keys) and self.weights[slot] > 0:
+                return self.keys[slot]
+
+        #If that keeps happening, the key with the largest weight is as good a pick as any.
+        return self.keys[max(range(len(self.weights)), key=self.weights.__getitem__)]
+
+#This class picks files from a bot's database using a selection strategy, in O(log n) time however many files there are.
+#The weights of the files are read from the database once, and then kept up to date as files are changed, see changed().
+class Selector:
+
+    def __init__(self, bot, strategy):
+
+        self.bot = bot
+        self.strategy = strategy
+
+        #A sampler for the files that haven't been posted, and one for every file, keyed by the no_repeat argument of Bot._select(). They are built when they are first needed.
+        self.samplers = {}
+
+        #Every change to the database made through the bot is tagged with a new revision, which is stored in the bot's state.
+        #If the revision in the database isn't the one we set, the database was changed by another process (or a transaction was rolled back), and the samplers are built again.
+        self.revision = None
+
+        #The IDs of files which have changed since the samplers were last updated.
+        self.pending = set()
+
+    #This function is called whenever files are changed, within the same transaction. If no IDs are given, every file is treated as changed.
+    def changed(self, ids=None):
+
+        self.revision = uuid.uuid4().hex
+
+        self.bot._setstate("selection_revision", self.revision)
+
+        if ids is None:
+            self.samplers = {}
+            self.pending = set()
+
+        else:
+            self.pending.update(ids)
+
+    #This function returns the sampler for either unposted files or all files, bringing it up to date first.
+    def _sampler(self, no_repeat):
+
+        if self.bot._getstate("selection_revision") != self.revision or self.strategy.stale():
+            self.samplers = {}
+            self.pending = set()
+
+        if self.pending:
+
+            #Reading back a large number of changes isn't any faster than starting again.
+            if len(self.pending) * 4 > max([len(sampler) for sampler in self.samplers.values()], default=0):
+                self.samplers = {}
+
+            else:
+                self._update()
+
+            self.pending = set()
+
+        if no_repeat not in self.samplers:
+            self.samplers[no_repeat] = self._build(no_repeat)
+
+        return self.samplers[no_repeat]
+
+    def _rows(self, where, params=()):
+
+        self.bot.cursor.execute("SELECT {} FROM '{}' WHERE GRP IS NULL {}".format(", ".join(COLUMNS), self.bot.name, where), params)
+
+        for values in self.bot.cursor:
+            yield dict(zip(COLUMNS, values))
+
+    def _build(self, no_repeat):
+
+        self.revision = self.bot._getstate("selection_revision")
+
+        if not self.samplers:
+            self.strategy.prepare()
+
+        groups = {}
+
+        for row in self._rows("AND POSTED=FALSE" if no_repeat else ""):
+            groups.setdefault(self.strategy.group(row), []).append((row["ID"], self.strategy.weight(row)))
+
+        return _Sampler(self.strategy, groups)
+
+    #This function reads back the files that have changed, and updates the samplers with them.
+    def _update(self):
+
+        pending = list(self.pending)
+
+        rows = {}
+
+        #SQLite limits how many values can be bound in one statement, so the files are read back in batches.
+        for start in range(0, len(pending), 500):
+
+            batch = pending[start:start + 500]
+
+            for row in self._rows("AND ID IN ({})".format(", ".join("?" * len(batch))), batch):
+                rows[row["ID"]] = row
+
+        for no_repeat, sampler in self.samplers.items():
+
+            for id in pending:
+
+                row = rows.get(id)
+
+                if row is None or (no_repeat and row["POSTED"]):
+                    sampler.discard(id)
+                else:
+                    sampler.set(id, self.strategy.group(row), self.strategy.weight(row))
+
+    #This function returns the number of files that can be picked, leaving out the excluded files.
+    def count(self, no_repeat=True, exclude=()):
+
+        sampler = self._sampler(no_repeat)
+
+        return sampler.positive - sum(sampler.pickable(id) for id in exclude)
+
+    #This function picks a file, and returns its ID, name, location, version and MIME type, or None if there is nothing to pick.
+    def pick(self, no_repeat=True, exclude=()):
+
+        sampler = self._sampler(no_repeat)
+
+        if sampler.positive - sum(sampler.pickable(id) for id in exclude) <= 0:
+            return None
+
+        #Files we were asked to exclude are skipped by picking again.
+        while True:
+
+            id = sampler.pick()
+
+            if id not in exclude:
+                break
+
+        self.bot.cursor.execute("SELECT ID, NAME, LOCATION, VERSION, MIMETYPE FROM '{}' WHERE ID=:ID".format(self.bot.name), {"ID":id})
+
+        return self.bot.cursor.fetchone()
+
+#This class holds the weights of a set of files, along with the weights of the groups they are in.
+class _Sampler:
+
+    def __init__(self, strategy, groups):
+
+        self.strategy = strategy
+
+        #The files in each group, and the group each file is in.
+        self.members = {group:WeightedSet(items) for group, items in groups.items()}
+        self.where = {id:group for group, items in groups.items() for id, weight in items}
+
+        #A group can only be picked if it has a file that can be picked.
+        self.groups = WeightedSet((group, self._group_weight(group)) for group in self.members)
+
+        #The number of files that can be picked.
+        self.positive = sum(self._positive(group) for group in self.members)
+
+    def __len__(self):
+        return len(self.where)
+
+    def _group_weight(self, group):
+        return self.strategy.group_weight(group) if self.members[group].positive else 0
+
+    def _positive(self, group):
+        return self.members[group].positive if group in self.members and self.strategy.group_weight(group) > 0 else 0
+
+    #This function returns True if a file can be picked.
+    def pickable(self, id):
+
+        if id not in self.where:
+            return False
+
+        group = self.where[id]
+
+        return self.strategy.group_weight(group) > 0 and self.members[group].weight(id) > 0
+
+    def set(self, id, group, weight):
+
+        #A file that has moved to another group is taken out of its old one first.
+        if id in self.where and self.where[id] != group:
+            self.discard(id)
+
+        self.positive -= self._positive(group)
+
+        self.members.setdefault(group, WeightedSet()).set(id, weight)
+        self.where[id] = group
+
+        self.positive += self._positive(group)
+
+        self.groups.set(group, self._group_weight(group))
+
+    def discard(self, id):
+
+        if id not in self.where:
+            return
+
+        group = self.where.pop(id)
+
+        self.positive -= self._positive(group)
+
+        self.members[group].discard(id)
+
+        self.positive += self._positive(group)
+
+        if self.members[group]:
+            self.groups.set(group, self._group_weight(group))
+
+        else:
+            del self.members[group]
+            self.groups.discard(group)
+
+    def pick(self):
+        return self.members[self.groups.pick()].pick()
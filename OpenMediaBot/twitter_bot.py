@@ -1,19 +1,20 @@
 #Import our bot baseclass.
 from .bot import Bot
 
-import json
+from .metrics import size
 
-#Used for Twitter.
-from twython import Twython
-from twython import TwythonError
+import json
 
 class TwitterBot(Bot):
 
+    #The Twitter client is only created when it is first used, along with the clients of the base class.
+    _clients = dict(Bot._clients, twitter="_connect_twitter")
+
     #The **kwargs here allows us to define keyword args in the bot class init function.
     def __init__(self, twitter_credfile="creds/twitter_creds.json", **kwargs):
         
         #This dictionary contains the default values for our Twitter bot's attributes.
-        defaults = {'dm_errors':True}
+        defaults = {'dm_errors':True,'processing_timeout':600,'derivative_dir':'derivatives','max_image_size':5242880,'max_image_dimension':4096,'batch_size':1,'max_retries':5,'retry_delay':60,'max_retry_delay':21600,'digest_interval':3600}
 
         #Update the attributes dictionary with the default values.
         #When we call the init of the base class, this will override the default values if specified in the kwargs.
@@ -22,125 +23,358 @@ class TwitterBot(Bot):
         #We call the init function of our base class, and pass it any arguments. 
         super().__init__(**kwargs)
 
+        self.twitter_credfile = twitter_credfile
+
+        #Posts that fail are kept in the outbox to be retried.
+        from .outbox import Outbox
+
+        self.outbox = Outbox(self, self.max_retries, self.retry_delay, self.max_retry_delay)
+
+    #This function creates an authenticated Twitter object.
+    def _connect_twitter(self):
+
         self.logger.info("Connecting to Twitter...")
-        
-        #Create an authenticated Twitter object.
-        with open(twitter_credfile) as jsonfile:
+
+        #Used for Twitter.
+        from twython import Twython
+
+        with open(self.twitter_credfile) as jsonfile:
             creds = json.load(jsonfile)
 
         self.twitter = Twython(creds['CONSUMER_KEY'], creds['CONSUMER_SECRET'],
                         creds['ACCESS_TOKEN'], creds['ACCESS_TOKEN_SECRET'])
 
     #The function posts a peice of media from Drive to Twitter.
+    #A list of up to 4 photos can be given instead of a single piece of media, which are posted together in one tweet.
     def post(self,media="random", status=None, updatedb=True):
 
+        with self.metrics.stage("post") as stage:
+            outcome = stage.outcome = self._post(media, status, updatedb)
+
+        self.metrics.flush()
+
+        return outcome
+
+    #This function does the work of post(), which times it. It returns the outcome of the post, which is "ok", "error", "rate_limited", or "waiting".
+    def _post(self, media, status, updatedb):
+
+        #This is set once we have started getting the next post ready.
+        prefetched = False
+
+        #If this post is a retry of one that failed, this is its entry in the outbox.
+        entry = None
+
+        #If Twitter has told us we are rate limited, trying to post would only fail again.
+        wait = self.outbox.limited()
+
+        if wait > 0:
+            self.logger.info("Rate limited by Twitter, not posting for another {} seconds.".format(round(wait)))
+            return "rate_limited"
+
         #Set this variable to "True" to update the database on each run.
         #This is the default behavior.
         if updatedb == True:
             self.updatedb()
 
-        #If we just want to post a random piece of media, grab a random one.
+        #If we just want to post a random piece of media, grab a random one, or a batch of them if "batch_size" is above 1.
         #This is the default behavior.
+        #Posts that failed and are due to be retried go first.
         if media == "random":
-            media=self.GetRandom()
+
+            retry = self.outbox.take()
+
+            if retry is not None:
+                entry, media, status = retry
+
+            else:
+
+                try:
+                    media=self.GetBatch(self.batch_size)
+
+                #If everything left to post is waiting to be retried, there is nothing to do until one of the retries is due.
+                except IndexError:
+
+                    if not len(self.outbox):
+                        raise
+
+                    self.logger.info("Nothing to post until a retry is due.")
+                    return "waiting"
+
+        #From here on, we handle a single piece of media as a batch of one.
+        batch = media if isinstance(media, list) else [media]
+
+        #Twitter only allows up to 4 photos in a tweet, and GIFs and videos have to be posted on their own.
+        if not 1 <= len(batch) <= 4:
+            raise ValueError("A tweet can have between 1 and 4 pieces of media, not {}.".format(len(batch)))
+
+        if len(batch) > 1 and not all(self._batchable(item.mimetype) for item in batch):
+            raise ValueError("Only photos can be posted together, GIFs and videos must be posted on their own.")
+
+        media = batch[0]
 
         try:
             #If the media is a video, special action must be taken.
-            if ("video" in media.mimetype) == True:
+            if len(batch) == 1 and ("video" in media.mimetype) == True:
                 #I owe this next snipped of code to Sidney Chieng. Check it out here.                
                 #https://sidneyochieng.co.ke/2019/05/uploading-videos-longer-that-30-seconds-to-twitter-using-twython/
                 
                 self.logger.info("Uploading video to Twitter...")
 
                 #The kwargs here allow us to upload a large video to Twitter in chunks.
-                response = self.twitter.upload_video(media.data, media_type=media.mimetype, check_progress=True, media_category='tweet_video')
+                with self.metrics.stage("upload_video") as stage:
+                    stage.bytes = size(media.data)
+                    response = self.twitter.upload_video(media.data, media_type=media.mimetype, media_category='tweet_video')
 
-                processing_info = response['processing_info']
-                
-                state = processing_info['state']
-                
-                wait = processing_info.get('check_after_secs', 1)
-                
-                #We need to check and see if the video is ready to be posted.
-                if (state == 'pending' or state == 'in_progress'):
+                #Twitter has to process the video before it can be posted, which we keep track of on another thread.
+                tracker = self.track_processing(response)
 
-                    import time
+                if tracker.state is not None:
 
-                    #If the video isn't ready to be posted, wait the specified amount of time.
-                    self.logger.info('Waiting ' + wait + 's to post.')
-                    time.sleep(wait)
+                    self.logger.info("Waiting for Twitter to process video...")
 
-            #If it's not a video, it must be a photo, so we treat it as such.
-            else:
-                self.logger.info("Uploading photo to Twitter...")
-                try:
-                    #Upload the media to twitter for posting.
-                    response=self.twitter.upload_media(media=media.data)
+                    future = tracker.start()
 
-                #A TywthonError may indicate the image is too large to be posted.
-                #Generally, we can combat this by reducing the image's color depth, which normally doesn't have an effect on image quality in my cases (anime images).
-                except TwythonError:
-                    from PIL import Image
-                    from io import BytesIO
-                    #By just running the image through PIL, it converts it to 8-bit color depth automatically.
-                    with Image.open(media.data) as im:
-                        with BytesIO() as image:
-                            im.save(image, format=im.format)
+                    #While we wait, we can get the next post ready.
+                    #The video hasn't been posted yet, so the database mustn't be reset to find something to stage, or the video would be picked again in the next cycle.
+                    if self.prefetcher is not None:
+                        self._prefetch(exclude=(media.id,), reset=False)
+                        prefetched = True
 
-                            #Make sure the image is being read from the beginning.
-                            image.seek(0)
+                    with self.metrics.stage("processing"):
+                        response = future.result()
 
-                            #Upload the media to twitter for posting.
-                            response=self.twitter.upload_media(media=image)
+                media_ids = [response['media_id']]
+
+            #If it's not a video, it must be a photo, so we treat it as such.
+            else:
+                responses = self._upload_photos(batch)
+
+                media_ids = [photo['media_id'] for photo in responses]
 
             self.logger.info("Posting to Twitter...")
             
             #Post the tweet!
-            tweet = self.twitter.update_status(status=status, media_ids=[response['media_id']])
+            with self.metrics.stage("update_status"):
+                tweet = self.twitter.update_status(status=status, media_ids=media_ids)
             
-            self.logger.info("POSTED: {} ({}), TWEETID: {}".format(media.name, media.id,tweet['id']))
+            for media in batch:
+                self.logger.info("POSTED: {} ({}), TWEETID: {}".format(media.name, media.id,tweet['id']))
 
-            #Good practice to close media objects after we are done with them.
-            media.data.close()
+                #Good practice to close media objects after we are done with them.
+                media.data.close()
 
             #Now, we set the posted value to True, since we have posted the image.
+            #Every piece of media in the tweet is marked in one transaction, so either all of them are marked or none are.
             with self.connection:
                 self.logger.info("Updating database...")
-                self.cursor.execute("UPDATE '{}' SET POSTED=TRUE WHERE ID=:ID".format(self.name),
-                {"ID":media.id})
+                self._posted([media.id for media in batch])
                 self.logger.info("Database Updated!")
+
+            if entry is not None:
+                self.outbox.done(entry)
+
+            outcome = "ok"
         
         #Error handling!
         except Exception as e:
-            #If specified, DM errors to admin account(s)
-            #This is the default behavior.
-            if self.dm_errors:
-
-                #When handling errors, we try to send the most detailed report to the admin(s) on Twitter.
-                for admin in self.admin_ids:
-                    #Try to send the most detailed report.
-                    try:
-                        message = "An error has occured:\n File: {}\n ID: {}\n Error: {}\n Twitter HTTP Response: {}".format(media.name, media.id, str(e), response)
-                        self.twitter.send_direct_message(event= {"type": "message_create", "message_create": {"target": {"recipient_id": admin}, "message_data": {"text": message}}})                
-                    
-                    #An UnboundLocalError would indicate that "response" as not been set, so we exclude it from our message.
-                    except UnboundLocalError:
-                        message = "An error has occured:\n File: {}\n ID: {}\n Error: {}".format(media.name, media.id, str(e))
-                        self.twitter.send_direct_message(event= {"type": "message_create", "message_create": {"target": {"recipient_id": admin}, "message_data": {"text": message}}})                
-                    
-                    #Any other errors, and we try to send the most basic message.
-                    except:
-                        
-                        #Try to send basic message.
-                        try:
-                            self.twitter.send_direct_message(event= {"type": "message_create", "message_create": {"target": {"recipient_id": admin}, "message_data": {"text": str(e)}}})
-
-                        #If we can't do that, log that we can't DM.
-                        except:
-                            self.logger.error("Unable to DM admin(s)!")
-                
+
+            #Nothing in the batch was posted, so none of it is marked as posted.
+            #Instead, the post is put in the outbox to be tried again later, waiting until Twitter's rate limit resets if that is what went wrong.
+            from twython import TwythonRateLimitError
+
+            retry_at = None
+
+            if isinstance(e, TwythonRateLimitError) and e.retry_after:
+                retry_at = float(e.retry_after)
+                self.outbox.rate_limit(retry_at)
+
+            self.outbox.failed([item.id for item in batch], status, e, entry, retry_at)
+
             #Log errors no matter what.
             self.logger.exception("An error has occured!")
 
-            #Make sure we close the media object.    
-            media.data.close()
\ No newline at end of file
+            #Make sure we close the media objects.    
+            for item in batch:
+                item.data.close()
+
+            outcome = "error"
+
+        #These run once the post has been made, so they can never make it count as a failure.
+        if outcome == "ok":
+
+            #If that was the last post Twitter will allow for now, wait until the limit resets before posting again.
+            self._check_rate_limit()
+
+            #If prefetching is enabled, start getting the next post ready.
+            if self.prefetcher is not None and not prefetched:
+                self._prefetch()
+
+        #If specified, send a digest of any errors to the admin(s), instead of a message for every error.
+        #This is the default behavior.
+        if self.dm_errors:
+            self.send_digest()
+
+        return outcome
+
+    #This function returns a dictionary of statistics about the bot's database, along with the number of posts waiting to be retried and how long we are rate limited for.
+    def stats(self):
+
+        stats = super().stats()
+
+        stats["retries"] = len(self.outbox)
+        stats["rate_limited"] = self.outbox.limited()
+
+        return stats
+
+    #This function sends a digest of the errors since the last one to the admin(s) as a DM, if there were any and the last digest was at least "digest_interval" seconds ago.
+    #If the digest can't be sent, the errors are kept for the next one.
+    def send_digest(self):
+
+        message = self.outbox.digest(self.digest_interval)
+
+        if message is None:
+            return
+
+        try:
+            for admin in self.admin_ids:
+                self.twitter.send_direct_message(event= {"type": "message_create", "message_create": {"target": {"recipient_id": admin}, "message_data": {"text": message}}})
+
+        #If we can't DM, log that we can't.
+        except Exception:
+            self.logger.exception("Unable to DM admin(s)!")
+
+        else:
+            self.outbox.sent()
+
+    #This function checks the rate limit headers of the last call to Twitter, and records when the limit resets if we have run out.
+    def _check_rate_limit(self):
+
+        try:
+            remaining = self.twitter.get_lastfunction_header('x-rate-limit-remaining')
+            reset = self.twitter.get_lastfunction_header('x-rate-limit-reset')
+
+            if remaining is not None and reset is not None and int(remaining) == 0:
+                self.outbox.rate_limit(float(reset))
+
+        except Exception:
+            self.logger.exception("Unable to check Twitter's rate limit!")
+
+    #This function starts getting the next post ready. Prefetching only saves time, so if it fails, it is logged and the next post picks its media as usual.
+    def _prefetch(self, exclude=(), reset=True):
+
+        try:
+            self.prefetcher.start(exclude=exclude, reset=reset)
+
+        except Exception:
+            self.logger.exception("Unable to prefetch the next post!")
+
+    #This function uploads photos to Twitter at the same time, on a pool of threads, and returns Twitter's response for each of them.
+    #If any of the uploads fail, the error is raised once they have all finished.
+    def _upload_photos(self, batch):
+
+        from concurrent.futures import ThreadPoolExecutor
+
+        def upload(media):
+
+            #Make sure the image is within Twitter's limits before we upload it, so the upload doesn't fail.
+            self._prepare(media)
+
+            #Upload the media to twitter for posting.
+            with self.metrics.stage("upload_media") as stage:
+                stage.bytes = size(media.data)
+                return self.twitter.upload_media(media=media.data)
+
+        self.logger.info("Uploading {} photo(s) to Twitter...".format(len(batch)))
+
+        with ThreadPoolExecutor(len(batch)) as executor:
+            return list(executor.map(upload, batch))
+
+    #Media that is waiting in the outbox to be retried is never picked for a new post, otherwise it would be uploaded again on every run until its retry is due.
+    def _held(self):
+        return self.outbox.ids()
+
+    #Twitter allows up to 4 photos in a tweet, but GIFs and videos have to be posted on their own.
+    def _batchable(self, mimetype):
+        return mimetype is not None and mimetype.startswith("image/") and mimetype != "image/gif"
+
+    #This function returns a tracker for media that Twitter is processing, given the response to its upload.
+    #The tracker can be waited on, or run in the background using its start() method.
+    def track_processing(self, response):
+
+        from .processing import ProcessingTracker
+
+        return ProcessingTracker(self._media_status, response['media_id'], response, timeout=self.processing_timeout)
+
+    #This function asks Twitter for the processing status of uploaded media.
+    def _media_status(self, media_id):
+        return self.twitter.get('https://upload.twitter.com/1.1/media/upload.json', params={'command':'STATUS', 'media_id':media_id})
+
+    #This function makes sure that a photo is within Twitter's limits.
+    #If it isn't, the media's data is replaced with a smaller copy of the image, which is cached in "derivative_dir" so it only has to be made once.
+    def _prepare(self, media):
+
+        from .preprocess import prepare
+
+        #Use the path of the media if it has one, so the image doesn't have to be read into memory.
+        source = media.data.name if isinstance(getattr(media.data, "name", None), str) else media.data
+
+        with self.metrics.stage("prepare") as stage:
+
+            path = prepare(source, self.derivative_dir, self.max_image_size, self.max_image_dimension)
+
+            #The outcome tells us whether the photo was already within Twitter's limits.
+            stage.outcome = "compliant" if path is None else "derived"
+
+        media.data.seek(0)
+
+        if path is not None:
+
+            self.logger.info("Using a smaller copy of {} ({})...".format(media.name, media.id))
+
+            media.data.close()
+            media.data = open(path, "rb")
+
+    #This function is called by the prefetcher on its background thread, once a file has been staged.
+    #Photos are prepared ahead of time, so the next post doesn't have to wait for it.
+    def _prestage(self, path, mimetype):
+
+        from .preprocess import prepare
+
+        if mimetype is not None and mimetype.startswith("image/"):
+            prepare(path, self.derivative_dir, self.max_image_size, self.max_image_dimension)
+
+    #This function prepares every photo in the library ahead of time, using a pool of threads.
+    #Local files are prepared, along with any Drive files that are in the media cache.
+    #It returns a dictionary with the number of photos that were already within Twitter's limits, that needed a smaller copy, and that could not be prepared.
+    def preprocess_library(self, workers=None):
+
+        from concurrent.futures import ThreadPoolExecutor
+        from .preprocess import prepare
+
+        self.logger.info("Preparing photos...")
+
+        self.cursor.execute("SELECT ID FROM '{}' WHERE LOCATION='LOCAL' AND MIMETYPE LIKE 'image/%'".format(self.name))
+        paths = [row[0] for row in self.cursor.fetchall()]
+
+        if self.cache is not None:
+            self.cursor.execute("SELECT PATH FROM '{}' WHERE MIMETYPE LIKE 'image/%'".format(self.cache.table))
+            paths.extend(row[0] for row in self.cursor.fetchall())
+
+        counts = {"compliant":0, "derived":0, "failed":0}
+
+        with ThreadPoolExecutor(workers) as executor:
+
+            futures = {executor.submit(prepare, path, self.derivative_dir, self.max_image_size, self.max_image_dimension):path for path in paths}
+
+            for future, path in futures.items():
+
+                try:
+                    counts["compliant" if future.result() is None else "derived"] += 1
+
+                except Exception as e:
+                    counts["failed"] += 1
+                    self.logger.info("Unable to prepare {}: {}".format(path, e))
+
+        self.logger.info("{compliant} photos were within limits, {derived} needed a smaller copy, {failed} could not be prepared.".format(**counts))
+
+        return counts
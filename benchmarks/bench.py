@@ -0,0 +1,261 @@
+#This script benchmarks OpenMediaBot against synthetic libraries, using in-process fakes of Google Drive and Twitter.
+#It measures how long it takes to sync the database, pick media, and post, along with peak memory, and writes the results as JSON so runs can be compared across commits.
+#Run it from the root of the repository, for example:
+#    python -m benchmarks.bench --sizes 10000 100000 --drive-latency 0.05 --output results.json
+#Each library size is run in its own process, so that peak memory isn't carried over from one size to the next.
+import os
+
+import sys
+
+import json
+
+import time
+
+import random
+
+import logging
+
+import argparse
+
+import platform
+
+import statistics
+
+import subprocess
+
+import tempfile
+
+import shutil
+
+#This function returns the peak memory used by this process so far, in bytes, or None if it can't be measured on this platform.
+def peak_memory():
+
+    try:
+        import resource
+
+    except ImportError:
+        return None
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    #Linux reports kilobytes, macOS reports bytes.
+    return peak if sys.platform == "darwin" else peak * 1024
+
+#This function summarizes a list of durations in seconds.
+def summary(samples):
+
+    samples = sorted(samples)
+
+    return {"count":len(samples), "mean":statistics.mean(samples), "median":statistics.median(samples),
+            "p95":samples[min(len(samples) - 1, int(len(samples) * 0.95))], "min":samples[0], "max":samples[-1]}
+
+#This function times a function, and returns how long it took along with what it returned.
+def timed(function, *args, **kwargs):
+
+    start = time.perf_counter()
+
+    result = function(*args, **kwargs)
+
+    return time.perf_counter() - start, result
+
+#This function creates "count" local files, spread across subfolders of "per_folder" files each.
+def local_library(directory, count, content, per_folder=1000):
+
+    for i in range(count):
+
+        folder = os.path.join(directory, "{:05d}".format(i // per_folder))
+
+        if i % per_folder == 0:
+            os.makedirs(folder, exist_ok=True)
+
+        with open(os.path.join(folder, "{:07d}.png".format(i)), "wb") as file:
+            file.write(content)
+
+#This function runs every benchmark on one library, and returns the results.
+def run(size, drive_fraction=0.5, drive_folders=4, drive_workers=4, drive_latency=0, twitter_latency=0, picks=200, posts=20, change_fraction=0.01, seed=0, workdir=None):
+
+    from OpenMediaBot.bot import Bot
+    from OpenMediaBot.twitter_bot import TwitterBot
+    from .fakes import FakeDrive, FakeTwitter, png
+
+    random.seed(seed)
+
+    workdir = tempfile.mkdtemp(prefix="omb-bench-", dir=workdir)
+
+    results = {"size":size, "drive_files":0, "local_files":0, "memory":{}}
+
+    try:
+        content = png()
+
+        drive_count = int(size * drive_fraction)
+        local_count = size - drive_count
+
+        drive = FakeDrive(drive_latency, content)
+
+        folders = ["folder{}".format(i) for i in range(drive_folders)]
+
+        for i, folder in enumerate(folders):
+            drive.populate(folder, drive_count // drive_folders + (i < drive_count % drive_folders))
+
+        local = os.path.join(workdir, "local")
+        local_library(local, local_count, content)
+
+        results["drive_files"] = drive_count
+        results["local_files"] = local_count
+
+        results["memory"]["library"] = peak_memory()
+
+        db = os.path.join(workdir, "media.db")
+
+        settings = {"db":db, "drive_folders":folders, "drive_client":drive, "local_folders":[local], "drive_workers":drive_workers, "incremental_sync":True, "staging_dir":os.path.join(workdir, "staging")}
+
+        #The bot logs every file it adds, which would be most of the time spent syncing, so only warnings are logged.
+        def quiet(bot):
+            bot.logger.setLevel(logging.WARNING)
+            return bot
+
+        bot = quiet(Bot(name="bench", **settings))
+
+        #The first sync lists every folder, the second finds nothing has changed, and the third applies a small number of changes.
+        results["sync_cold"], changes = timed(bot.updatedb)
+        results["memory"]["sync_cold"] = peak_memory()
+
+        results["sync_warm"], changes = timed(bot.updatedb)
+
+        for id in random.sample(sorted(drive.files), int(drive_count * change_fraction)):
+            drive.put(id, "renamed-" + drive.files[id]["title"], drive.files[id]["parents"][0]["id"])
+
+        local_library(os.path.join(local, "new"), int(local_count * change_fraction), content)
+
+        results["sync_changes"], changes = timed(bot.updatedb)
+        results["changes"] = changes
+        results["memory"]["sync"] = peak_memory()
+
+        #Picking media, using the default query and then a selection strategy, whose first pick includes reading the weights.
+        results["select"] = summary([timed(bot._select)[0] for i in range(picks)])
+        results["memory"]["select"] = peak_memory()
+
+        weighted = quiet(Bot(name="bench", selection="folder", **settings))
+
+        results["select_weighted_first"], row = timed(weighted._select)
+        results["select_weighted"] = summary([timed(weighted._select)[0] for i in range(picks)])
+        results["memory"]["select_weighted"] = peak_memory()
+
+        #Grouping duplicates, first from scratch and then after a small number of files change.
+        #The files are given synthetic hashes directly, as Drive files are, so that no files need to be read, with one in ten a near duplicate of another.
+        deduped = quiet(Bot(name="dedup", db=db, dedup=True, staging_dir=settings["staging_dir"]))
+
+        hashes = []
+
+        for i in range(size):
+
+            phash = random.getrandbits(64)
+
+            if hashes and random.random() < 0.1:
+                phash = int(random.choice(hashes)[2], 16) ^ 1 << random.randrange(64)
+
+            hashes.append(("dedup-{:07d}".format(i), "{:032x}".format(random.getrandbits(128)), "{:016x}".format(phash)))
+
+        with deduped.connection:
+            deduped.cursor.executemany("INSERT INTO dedup (ID, NAME, LOCATION, POSTED, HASH, PHASH) VALUES (?, ?, 'DRIVE', FALSE, ?, ?)", [(id, id, exact, phash) for id, exact, phash in hashes])
+
+        results["dedup_cold"], row = timed(deduped._dedup, {})
+
+        changed = random.sample(hashes, int(size * change_fraction))
+
+        with deduped.connection:
+            deduped.cursor.executemany("UPDATE dedup SET HASH=?, PHASH=? WHERE ID=?", [("{:032x}".format(random.getrandbits(128)), "{:016x}".format(random.getrandbits(64)), id) for id, exact, phash in changed])
+
+        results["dedup_changes"], row = timed(deduped._dedup, {"modified":len(changed)})
+        results["memory"]["dedup"] = peak_memory()
+
+        #Posting, from picking the media to marking it as posted.
+        credfile = os.path.join(workdir, "creds.json")
+
+        with open(credfile, "w") as file:
+            json.dump({"CONSUMER_KEY":"", "CONSUMER_SECRET":"", "ACCESS_TOKEN":"", "ACCESS_TOKEN_SECRET":""}, file)
+
+        twitter = quiet(TwitterBot(twitter_credfile=credfile, name="bench", dm_errors=False, derivative_dir=os.path.join(workdir, "derivatives"), **settings))
+        twitter.twitter = FakeTwitter(twitter_latency)
+
+        results["post"] = summary([timed(twitter.post, updatedb=False)[0] for i in range(posts)])
+        results["posted"] = len(twitter.twitter.tweets)
+        results["memory"]["post"] = peak_memory()
+
+        results["drive_calls"] = drive.calls
+        results["twitter_calls"] = twitter.twitter.calls
+
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    return results
+
+#This function returns the commit the benchmarks are being run on, or None if it can't be found.
+def commit():
+
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def main(args=None):
+
+    parser = argparse.ArgumentParser(description="Benchmark OpenMediaBot against synthetic libraries.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10000, 100000], help="The number of files in each library to benchmark.")
+    parser.add_argument("--drive-fraction", type=float, default=0.5, help="The fraction of each library that is on Google Drive, the rest is local.")
+    parser.add_argument("--drive-folders", type=int, default=4, help="The number of Drive folders the Drive files are spread across.")
+    parser.add_argument("--drive-workers", type=int, default=4, help="The number of Drive folders the bot lists at the same time.")
+    parser.add_argument("--drive-latency", type=float, default=0, help="Seconds each call to the fake Google Drive, or page of a folder, takes.")
+    parser.add_argument("--twitter-latency", type=float, default=0, help="Seconds each call to the fake Twitter takes.")
+    parser.add_argument("--picks", type=int, default=200, help="The number of picks to time.")
+    parser.add_argument("--posts", type=int, default=20, help="The number of posts to time.")
+    parser.add_argument("--change-fraction", type=float, default=0.01, help="The fraction of files changed before the last sync.")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--workdir", help="Directory to create the libraries in, by default the system's temporary directory.")
+    parser.add_argument("--output", default="benchmark-results.json", help="The file to write the results to.")
+
+    #This is used to run a single size in a new process.
+    parser.add_argument("--worker", type=int, help=argparse.SUPPRESS)
+
+    args = parser.parse_args(args)
+
+    options = {"drive_fraction":args.drive_fraction, "drive_folders":args.drive_folders, "drive_workers":args.drive_workers, "drive_latency":args.drive_latency, "twitter_latency":args.twitter_latency,
+               "picks":args.picks, "posts":args.posts, "change_fraction":args.change_fraction, "seed":args.seed}
+
+    if args.worker is not None:
+        json.dump(run(args.worker, workdir=args.workdir, **options), sys.stdout)
+        return
+
+    report = {"commit":commit(), "time":time.strftime("%Y-%m-%dT%H:%M:%S%z"), "python":platform.python_version(), "platform":platform.platform(),
+              "options":options, "results":[]}
+
+    for size in args.sizes:
+
+        print("Benchmarking a library of {} files...".format(size), file=sys.stderr)
+
+        command = [sys.executable, "-m", "benchmarks.bench", "--worker", str(size)]
+
+        for option, value in options.items():
+            command += ["--" + option.replace("_", "-"), str(value)]
+
+        if args.workdir is not None:
+            command += ["--workdir", args.workdir]
+
+        result = json.loads(subprocess.run(command, capture_output=True, text=True, check=True, cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__)))).stdout)
+
+        report["results"].append(result)
+
+        print("  sync: {:.2f}s cold, {:.2f}s warm, {:.2f}s with changes".format(result["sync_cold"], result["sync_warm"], result["sync_changes"]), file=sys.stderr)
+        print("  select: {:.2f}ms median, weighted {:.3f}ms median ({:.2f}s to read weights)".format(result["select"]["median"] * 1000, result["select_weighted"]["median"] * 1000, result["select_weighted_first"]), file=sys.stderr)
+        print("  dedup: {:.2f}s from scratch, {:.2f}s with changes".format(result["dedup_cold"], result["dedup_changes"]), file=sys.stderr)
+        print("  post: {:.2f}ms median, {:.2f}ms p95".format(result["post"]["median"] * 1000, result["post"]["p95"] * 1000), file=sys.stderr)
+        print("  peak memory: {} MiB".format(max(value or 0 for value in result["memory"].values()) // 1048576), file=sys.stderr)
+
+    with open(args.output, "w") as file:
+        json.dump(report, file, indent=2)
+
+    print("Results written to {}.".format(args.output), file=sys.stderr)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,195 @@
+import time
+
+import hashlib
+
+import itertools
+
+from io import BytesIO
+
+from OpenMediaBot.drive import DriveClient, InvalidTokenError, FOLDER
+
+#This function returns the bytes of a small, valid PNG, which is used as the content of every synthetic file.
+def png():
+
+    from PIL import Image
+
+    with BytesIO() as data:
+        Image.new("RGB", (8, 8), (200, 30, 90)).save(data, format="PNG")
+        return data.getvalue()
+
+#This class is an in-process stand-in for Google Drive, holding synthetic files spread across folders.
+#Every call, and every page of a folder, sleeps for "latency" seconds first, to stand in for the round trip to Google.
+class FakeDrive(DriveClient):
+
+    def __init__(self, latency=0, content=b"", page_size=1000):
+
+        self.latency = latency
+        self.content = content
+        self.page_size = page_size
+
+        #Files by ID, and the changes feed, which is a list of changes.
+        self.files = {}
+        self.changes = []
+
+        #The number of calls made, by method.
+        self.calls = {}
+
+    def _call(self, name):
+
+        self.calls[name] = self.calls.get(name, 0) + 1
+
+        if self.latency:
+            time.sleep(self.latency)
+
+    #This function adds "count" files to a folder, and returns their IDs.
+    def populate(self, folder, count):
+
+        ids = []
+
+        for i in range(count):
+
+            id = "{}-{:07d}".format(folder, i)
+
+            self.put(id, "{}.png".format(id), folder)
+
+            ids.append(id)
+
+        return ids
+
+    #This function adds or changes a file, and adds it to the changes feed.
+    def put(self, id, title, folder):
+
+        #Like Drive, the checksum of a file changes when its content does, which here is whenever it is put.
+        self.files[id] = {"id":id, "title":title, "mimeType":"image/png", "md5Checksum":hashlib.md5("{}:{}".format(id, len(self.changes)).encode()).hexdigest(),
+                          "fileSize":str(len(self.content)), "parents":[{"id":folder}], "labels":{"trashed":False}}
+
+        self.changes.append({"fileId":id, "deleted":False, "file":self.files[id]})
+
+    #These functions change a file the way a user would in Drive, each adding a change to the feed.
+    #Renaming a file doesn't change its content, so its checksum stays the same.
+    def rename(self, id, title):
+        self._change(id, title=title)
+
+    def move(self, id, folder):
+        self._change(id, parents=[{"id":folder}])
+
+    def trash(self, id):
+        self._change(id, labels={"trashed":True})
+
+    def _change(self, id, **fields):
+
+        self.files[id] = dict(self.files[id], **fields)
+
+        self.changes.append({"fileId":id, "deleted":False, "file":self.files[id]})
+
+    #This function adds a folder inside another folder.
+    def mkdir(self, id, parent):
+
+        self.files[id] = {"id":id, "title":id, "mimeType":FOLDER, "parents":[{"id":parent}], "labels":{"trashed":False}}
+
+        self.changes.append({"fileId":id, "deleted":False, "file":self.files[id]})
+
+    def delete(self, id):
+
+        del self.files[id]
+
+        self.changes.append({"fileId":id, "deleted":True})
+
+    def list_folder(self, folder_id):
+
+        self._call("list_folder")
+
+        return self._children(folder_id)
+
+    def list_pages(self, folder_id):
+
+        files = self._children(folder_id)
+
+        for start in range(0, max(len(files), 1), self.page_size):
+
+            self._call("list_pages")
+
+            yield files[start:start + self.page_size]
+
+    #Like Drive, listing a folder leaves out the files in the trash.
+    def _children(self, folder_id):
+        return [file for file in self.files.values() if file["parents"][0]["id"] == folder_id and not file["labels"]["trashed"]]
+
+    def get_start_token(self):
+
+        self._call("get_start_token")
+
+        return str(len(self.changes))
+
+    def list_changes(self, token):
+
+        self._call("list_changes")
+
+        if not token.isdigit() or int(token) > len(self.changes):
+            raise InvalidTokenError(token)
+
+        return self.changes[int(token):], str(len(self.changes))
+
+    def open_file(self, id):
+
+        self._call("open_file")
+
+        return self.files[id], [self.content]
+
+#This class is an in-process stand-in for Twython, with the methods that bots use.
+#Every call sleeps for "latency" seconds first, to stand in for the round trip to Twitter.
+class FakeTwitter:
+
+    def __init__(self, latency=0):
+
+        self.latency = latency
+
+        self.ids = itertools.count(1)
+
+        self.calls = {}
+
+        #Posted tweets, as tuples of their status and media IDs.
+        self.tweets = []
+
+    def _call(self, name):
+
+        self.calls[name] = self.calls.get(name, 0) + 1
+
+        if self.latency:
+            time.sleep(self.latency)
+
+    def upload_media(self, media):
+
+        self._call("upload_media")
+
+        media.read()
+
+        return {"media_id":next(self.ids)}
+
+    def upload_video(self, media, media_type, media_category=None, check_progress=False):
+
+        self._call("upload_video")
+
+        media.read()
+
+        return {"media_id":next(self.ids)}
+
+    def get(self, endpoint, params=None):
+
+        self._call("get")
+
+        return {"media_id":params["media_id"], "processing_info":{"state":"succeeded"}}
+
+    def update_status(self, status=None, media_ids=None):
+
+        self._call("update_status")
+
+        self.tweets.append((status, media_ids))
+
+        return {"id":next(self.ids)}
+
+    def send_direct_message(self, event=None):
+        self._call("send_direct_message")
+
+    def get_lastfunction_header(self, header, default_return_value=None):
+        return default_return_value
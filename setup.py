@@ -22,7 +22,10 @@ setuptools.setup(
         "Development Status :: 5 - Production/Stable"
     ],
     package_dir={"": "."},
-    packages=setuptools.find_packages(where="."),
+    packages=setuptools.find_packages(where=".", exclude=["benchmarks"]),
+    entry_points={
+        "console_scripts": ["openmediabot=OpenMediaBot.cli:main"],
+    },
     install_requires = [
         'pydrive2',
         'twython',
@@ -0,0 +1,154 @@
+import os
+
+import logging
+
+import pytest
+
+from OpenMediaBot.bot import Bot
+
+from benchmarks.fakes import FakeDrive
+
+#Every file in the fake Drive is 100 bytes, so a cache of 250 bytes holds two of them.
+@pytest.fixture
+def drive():
+
+    drive = FakeDrive(content=b"x" * 100)
+
+    drive.populate("A", 4)
+
+    return drive
+
+def make_bot(tmp_path, drive, cache_size=250):
+
+    bot = Bot(name="test", db=str(tmp_path / "media.db"), staging_dir=str(tmp_path / "staging"), drive_folders=["A"], drive_client=drive,
+              cache_dir=str(tmp_path / "cache"), cache_size=cache_size)
+    bot.logger.setLevel(logging.WARNING)
+
+    bot.updatedb()
+
+    return bot
+
+#This function downloads a file through the cache, the way the bot does when it posts it.
+def download(bot, id):
+
+    bot.cursor.execute("SELECT VERSION, NAME FROM test WHERE ID=:ID", {"ID":id})
+    version, name = bot.cursor.fetchone()
+
+    media = bot.DownloadFromDrive(id, version, name)
+
+    with media.data:
+        return media.data.read()
+
+def cached(bot):
+
+    bot.cursor.execute("SELECT ID FROM test_CACHE")
+
+    return {row[0] for row in bot.cursor.fetchall()}
+
+def test_hit(tmp_path, drive):
+
+    bot = make_bot(tmp_path, drive)
+
+    assert download(bot, "A-0000000") == b"x" * 100
+    assert download(bot, "A-0000000") == b"x" * 100
+
+    assert drive.calls["open_file"] == 1
+    assert (bot.cache.hits, bot.cache.misses) == (1, 1)
+
+    #The counters are kept in the database, so they add up over every run of the bot.
+    bot.connection.close()
+
+    bot = make_bot(tmp_path, drive)
+
+    assert bot.cache.stats()["hit_rate"] == 0.5
+
+#The least recently used files are removed once the cache is too big.
+def test_evict(tmp_path, drive):
+
+    bot = make_bot(tmp_path, drive)
+
+    download(bot, "A-0000000")
+    download(bot, "A-0000001")
+
+    path = bot.cache.path("A-0000000", drive.files["A-0000000"]["md5Checksum"])
+
+    #Using the first file makes the second the least recently used.
+    download(bot, "A-0000000")
+    download(bot, "A-0000002")
+
+    assert cached(bot) == {"A-0000000", "A-0000002"}
+    assert bot.cache.evictions == 1
+    assert bot.cache.stats()["size"] <= 250
+    assert len(os.listdir(tmp_path / "cache")) == 2
+    assert os.path.exists(path)
+
+#A file that is bigger than the whole cache is kept until the next file is added.
+def test_evict_keeps_new_entry(tmp_path, drive):
+
+    bot = make_bot(tmp_path, drive, cache_size=50)
+
+    download(bot, "A-0000000")
+
+    assert cached(bot) == {"A-0000000"}
+
+    download(bot, "A-0000001")
+
+    assert cached(bot) == {"A-0000001"}
+    assert len(os.listdir(tmp_path / "cache")) == 1
+
+#A cached copy of an older version of a file counts as a miss, and is replaced.
+def test_version_changed(tmp_path, drive):
+
+    bot = make_bot(tmp_path, drive)
+
+    download(bot, "A-0000000")
+
+    old = drive.files["A-0000000"]["md5Checksum"]
+    path = bot.cache.path("A-0000000", old)
+
+    drive.put("A-0000000", "A-0000000.png", "A")
+
+    bot.cursor.execute("SELECT NAME FROM test WHERE ID='A-0000000'")
+    media = bot.DownloadFromDrive("A-0000000", drive.files["A-0000000"]["md5Checksum"], bot.cursor.fetchone()[0])
+    media.data.close()
+
+    assert drive.calls["open_file"] == 2
+    assert (bot.cache.hits, bot.cache.misses) == (0, 2)
+    assert bot.cache.path("A-0000000", old) is None
+    assert bot.cache.path("A-0000000", drive.files["A-0000000"]["md5Checksum"]) == path
+
+#Updating the database removes the cached copies of files that were modified or deleted.
+def test_invalidate(tmp_path, drive):
+
+    bot = make_bot(tmp_path, drive)
+
+    download(bot, "A-0000000")
+    download(bot, "A-0000001")
+
+    path = bot.cache.path("A-0000000", drive.files["A-0000000"]["md5Checksum"])
+
+    drive.delete("A-0000000")
+    drive.put("A-0000001", "A-0000001.png", "A")
+
+    bot.updatedb()
+
+    assert cached(bot) == set()
+    assert not os.path.exists(path)
+    assert os.listdir(tmp_path / "cache") == []
+
+#A file that was already downloaded, by the prefetcher for example, is moved into the cache.
+def test_adopt(tmp_path, drive):
+
+    bot = make_bot(tmp_path, drive)
+
+    source = tmp_path / "download"
+    source.write_bytes(b"y" * 100)
+
+    media = bot.cache.adopt("A-0000003", "v1", "A-0000003.png", "image/png", str(source))
+
+    with media.data:
+        assert media.data.read() == b"y" * 100
+
+    assert not source.exists()
+    assert cached(bot) == {"A-0000003"}
+    assert bot.cache.path("A-0000003", "v1") is not None
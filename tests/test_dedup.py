@@ -0,0 +1,195 @@
+import random
+
+import logging
+
+from OpenMediaBot.bot import Bot
+
+from OpenMediaBot.dedup import bands, distance, group
+
+#This function groups files by comparing every pair of them, which is what the index should give the same answer as.
+def reference(rows, radius):
+
+    groups = {row[0]:{row[0]} for row in rows}
+
+    for i, (a, exact_a, phash_a) in enumerate(rows):
+        for b, exact_b, phash_b in rows[i + 1:]:
+
+            if (exact_a is not None and exact_a == exact_b) or (phash_a is not None and phash_b is not None and distance(int(phash_a, 16), int(phash_b, 16)) <= radius):
+
+                merged = groups[a] | groups[b]
+
+                for id in merged:
+                    groups[id] = merged
+
+    return {id:min(ids) for id, ids in groups.items() if len(ids) > 1}
+
+#This function returns a perceptual hash that differs from another in "bits" random bits.
+def near(phash, bits):
+
+    value = int(phash, 16)
+
+    for bit in random.sample(range(64), bits):
+        value ^= 1 << bit
+
+    return "{:016x}".format(value)
+
+#This function returns a library of hashes with clusters of near and exact duplicates in it.
+def hashes(count, radius):
+
+    rows = []
+
+    for i in range(count):
+
+        if rows and random.random() < 0.5:
+            id, exact, phash = random.choice(rows)
+            rows.append(("{:04d}".format(i), exact if random.random() < 0.2 else str(i), near(phash, random.randint(0, radius + 2))))
+
+        else:
+            rows.append(("{:04d}".format(i), str(i), "{:016x}".format(random.getrandbits(64))))
+
+    return rows
+
+def test_bands():
+
+    random.seed(1)
+
+    for radius in (0, 1, 4, 10, 63):
+
+        for i in range(200):
+
+            a = random.getrandbits(64)
+            b = int(near("{:016x}".format(a), random.randint(0, radius)), 16)
+
+            assert set(bands(a, radius)) & set(bands(b, radius))
+
+def test_group():
+
+    random.seed(2)
+
+    for radius in (0, 2, 4):
+
+        rows = hashes(300, radius)
+
+        assert group(rows, radius) == reference(rows, radius)
+
+#This class is a bot whose files are given hashes directly, as Drive files are, so no files need to be read.
+class Library:
+
+    def __init__(self, tmp_path, radius=4):
+
+        self.bot = Bot(name="test", db=str(tmp_path / "media.db"), staging_dir=str(tmp_path / "staging"), dedup=True, dedup_distance=radius)
+        self.bot.logger.setLevel(logging.WARNING)
+
+        self.radius = radius
+
+    def put(self, rows):
+
+        with self.bot.connection:
+            self.bot.cursor.executemany("INSERT OR REPLACE INTO test (ID, NAME, LOCATION, POSTED, HASH, PHASH) VALUES (?, ?, 'DRIVE', FALSE, ?, ?)", [(id, id, exact, phash) for id, exact, phash in rows])
+
+        self.bot._dedup({"added":len(rows)})
+
+    def delete(self, ids):
+
+        with self.bot.connection:
+            self.bot.cursor.executemany("DELETE FROM test WHERE ID=?", [(id,) for id in ids])
+
+        self.bot._dedup({"deleted":len(ids)})
+
+    def rows(self):
+
+        self.bot.cursor.execute("SELECT ID, HASH, PHASH FROM test")
+
+        return self.bot.cursor.fetchall()
+
+    #This function returns every file's group, as group() does.
+    def groups(self):
+
+        self.bot.cursor.execute("SELECT ID, GRP FROM test")
+        rows = self.bot.cursor.fetchall()
+
+        duplicates = {id:grp for id, grp in rows if grp is not None}
+
+        return dict(duplicates, **{grp:grp for grp in duplicates.values()})
+
+#Groups are kept up to date as files are added, changed and deleted, and always match grouping the whole library again.
+def test_incremental(tmp_path):
+
+    random.seed(3)
+
+    library = Library(tmp_path)
+
+    rows = hashes(200, library.radius)
+
+    library.put(rows[:100])
+
+    assert library.groups() == reference(library.rows(), library.radius)
+
+    for i in range(30):
+
+        current = library.rows()
+
+        action = random.choice(("add", "change", "delete"))
+
+        if action == "add":
+            library.put(random.sample(rows[100:], 3))
+
+        elif action == "change":
+            id, exact, phash = random.choice(current)
+            library.put([(id, str(random.random()), near(random.choice(current)[2], random.randint(0, library.radius)))])
+
+        else:
+            library.delete([row[0] for row in random.sample(current, 3)])
+
+        assert library.groups() == reference(library.rows(), library.radius)
+
+#Deleting the file that links two others splits its group in two.
+def test_split(tmp_path):
+
+    library = Library(tmp_path, radius=2)
+
+    library.put([("a", "1", "0000000000000000"), ("b", "2", "0000000000000003"), ("c", "3", "000000000000000f"), ("d", "3", None)])
+
+    assert library.groups() == {"a":"a", "b":"a", "c":"a", "d":"a"}
+
+    library.delete(["b"])
+
+    assert library.groups() == {"c":"c", "d":"c"}
+
+    #Deleting the representative of a group moves it to the next smallest ID.
+    library.put([("e", "3", None)])
+    library.delete(["c"])
+
+    assert library.groups() == {"d":"d", "e":"d"}
+
+#A file joining a group that has already been posted is marked as posted too.
+def test_posted(tmp_path):
+
+    library = Library(tmp_path)
+
+    library.put([("a", "1", None), ("b", "1", None)])
+
+    with library.bot.connection:
+        library.bot._posted(["a"])
+
+    library.put([("c", "1", None)])
+
+    library.bot.cursor.execute("SELECT ID FROM test WHERE POSTED")
+
+    assert sorted(row[0] for row in library.bot.cursor.fetchall()) == ["a", "b", "c"]
+
+#Changing the distance groups every file again.
+def test_distance_changed(tmp_path):
+
+    library = Library(tmp_path, radius=0)
+
+    library.put([("a", "1", "0000000000000000"), ("b", "2", "0000000000000001")])
+
+    assert library.groups() == {}
+
+    library.bot.connection.close()
+
+    library = Library(tmp_path, radius=1)
+    library.bot._dedup({})
+
+    assert library.groups() == {"a":"a", "b":"a"}
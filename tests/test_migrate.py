@@ -0,0 +1,57 @@
+import sqlite3
+
+import logging
+
+import pytest
+
+from OpenMediaBot import bot as bot_module
+
+from OpenMediaBot.bot import Bot
+
+def make_bot(tmp_path):
+
+    bot = Bot(name="test", db=str(tmp_path / "media.db"), staging_dir=str(tmp_path / "staging"))
+    bot.logger.setLevel(logging.WARNING)
+
+    return bot
+
+def columns(bot):
+
+    bot.cursor.execute("PRAGMA table_info(test)")
+
+    return [row[1] for row in bot.cursor.fetchall()]
+
+#An upgrade that fails part of the way through leaves the table as it was, so it can be run again.
+def test_failed_upgrade(tmp_path, monkeypatch):
+
+    migrations = bot_module._MIGRATIONS
+
+    #A table made by the first version, before any columns were added.
+    monkeypatch.setattr(bot_module, "_MIGRATIONS", migrations[:2])
+    make_bot(tmp_path).connection.close()
+
+    #This upgrade fails after it has added some columns.
+    monkeypatch.setattr(bot_module, "_MIGRATIONS", migrations[:5] + ["ALTER TABLE '{0}' ADD COLUMN VERSION text;"])
+
+    with pytest.raises(sqlite3.OperationalError):
+        make_bot(tmp_path)
+
+    connection = sqlite3.connect(str(tmp_path / "media.db"))
+    assert [row[1] for row in connection.execute("PRAGMA table_info(test)")] == ["ID", "NAME", "LOCATION", "POSTED"]
+    connection.close()
+
+    monkeypatch.setattr(bot_module, "_MIGRATIONS", migrations)
+
+    bot = make_bot(tmp_path)
+
+    assert "LAST_POSTED" in columns(bot)
+    assert bot._getstate("schema_version") == str(len(migrations))
+
+#A bot whose table is already up to date doesn't run anything.
+def test_up_to_date(tmp_path):
+
+    make_bot(tmp_path).connection.close()
+
+    bot = make_bot(tmp_path)
+
+    assert bot._getstate("schema_version") == str(len(bot_module._MIGRATIONS))
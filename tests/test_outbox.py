@@ -0,0 +1,229 @@
+import logging
+
+import pytest
+
+from OpenMediaBot.twitter_bot import TwitterBot
+
+from benchmarks.fakes import FakeTwitter, png
+
+#This is a fake Twitter whose uploads fail while "failing" is set.
+class FlakyTwitter(FakeTwitter):
+
+    def __init__(self):
+
+        super().__init__()
+
+        self.failing = False
+
+    def upload_media(self, media):
+
+        if self.failing:
+            self._call("upload_media")
+            raise ConnectionError("Twitter is down")
+
+        return super().upload_media(media)
+
+#This is a clock that only moves when we move it.
+class Clock:
+
+    def __init__(self):
+        self.now = 1000000
+
+    def __call__(self):
+        return self.now
+
+@pytest.fixture
+def clock():
+    return Clock()
+
+#This function returns a bot with a library of local photos, posting to a flaky fake Twitter, with its outbox on a fake clock.
+def make_bot(tmp_path, clock, count=3, **settings):
+
+    library = tmp_path / "library"
+    library.mkdir()
+
+    for i in range(count):
+        (library / "{}.png".format(i)).write_bytes(png())
+
+    bot = TwitterBot(name="test", db=str(tmp_path / "media.db"), staging_dir=str(tmp_path / "staging"), derivative_dir=str(tmp_path / "derivatives"),
+                     local_folders=[str(library)], **dict({"dm_errors":False}, **settings))
+
+    bot.logger.setLevel(logging.CRITICAL)
+
+    bot.twitter = FlakyTwitter()
+    bot.outbox.clock = clock
+
+    return bot
+
+#When everything that hasn't been posted is waiting in the outbox, there is nothing to prefetch, which isn't an error.
+def test_prefetch_everything_held(tmp_path, clock):
+
+    bot = make_bot(tmp_path, clock, count=1, prefetch=True)
+
+    bot.twitter.failing = True
+
+    assert bot.post() == "error"
+
+    bot.prefetcher.start()
+
+    assert bot._getstate("staged") is None
+
+def posted(bot):
+
+    bot.cursor.execute("SELECT ID FROM test WHERE POSTED")
+
+    return {row[0] for row in bot.cursor.fetchall()}
+
+#A post that fails goes in the outbox, and its media isn't picked for another post until it has been retried.
+def test_failed_post_held(tmp_path, clock):
+
+    bot = make_bot(tmp_path, clock)
+
+    bot.twitter.failing = True
+
+    for i in range(3):
+        assert bot.post() == "error"
+
+    assert len(bot.outbox) == 3
+    assert len(bot.outbox.ids()) == 3
+
+    #Every file is waiting to be retried, and none are due, so there is nothing to post.
+    assert bot.post() == "waiting"
+
+    assert bot.twitter.calls["upload_media"] == 3
+    assert posted(bot) == set()
+
+def test_retry_when_due(tmp_path, clock):
+
+    bot = make_bot(tmp_path, clock, count=1)
+
+    bot.twitter.failing = True
+
+    assert bot.post() == "error"
+
+    held = bot.outbox.ids()
+
+    bot.twitter.failing = False
+
+    clock.now += 59
+
+    assert bot.post() == "waiting"
+
+    clock.now += 1
+
+    assert bot.post() == "ok"
+
+    assert len(bot.outbox) == 0
+    assert posted(bot) == held
+    assert len(bot.twitter.tweets) == 1
+
+#Each retry waits twice as long as the last, up to the longest delay, and the post is given up on after the last retry.
+def test_backoff(tmp_path, clock):
+
+    bot = make_bot(tmp_path, clock, max_retries=4, retry_delay=10, max_retry_delay=25)
+
+    delays = []
+
+    entry = None
+
+    for i in range(4):
+
+        assert bot.outbox.failed(["0"], None, ConnectionError("Twitter is down"), entry)
+
+        bot.cursor.execute("SELECT ENTRY, NEXT FROM test_OUTBOX")
+        entry, next = bot.cursor.fetchone()
+
+        delays.append(next - clock.now)
+
+    assert delays == [10, 20, 25, 25]
+
+    assert not bot.outbox.failed(["0"], None, ConnectionError("Twitter is down"), entry)
+
+    assert len(bot.outbox) == 0
+    assert "Gave up on: 0" in bot.outbox.digest(0)
+
+#A post that fails again without its entry being given updates the entry that is already waiting, rather than adding another.
+def test_failed_reuses_entry(tmp_path, clock):
+
+    bot = make_bot(tmp_path, clock)
+
+    bot.outbox.failed(["0", "1"], "status", ConnectionError("Twitter is down"))
+    bot.outbox.failed(["0", "1"], "status", ConnectionError("Twitter is down"))
+
+    bot.cursor.execute("SELECT IDS, ATTEMPTS FROM test_OUTBOX")
+
+    assert bot.cursor.fetchall() == [('["0", "1"]', 2)]
+
+#Retries of media that has since been deleted or posted are dropped.
+def test_take_drops(tmp_path, clock):
+
+    bot = make_bot(tmp_path, clock)
+    bot.updatedb()
+
+    bot.cursor.execute("SELECT ID FROM test ORDER BY ID")
+    ids = [row[0] for row in bot.cursor.fetchall()]
+
+    bot.outbox.failed([ids[0]], None, ConnectionError("Twitter is down"))
+    bot.outbox.failed(["deleted"], None, ConnectionError("Twitter is down"))
+
+    with bot.connection:
+        bot._posted([ids[0]])
+
+    clock.now += 60
+
+    assert bot.outbox.take() is None
+    assert len(bot.outbox) == 0
+
+def test_rate_limit(tmp_path, clock):
+
+    from twython import TwythonRateLimitError
+
+    bot = make_bot(tmp_path, clock, count=1)
+
+    def limited(media):
+        raise TwythonRateLimitError("Rate limit exceeded", 429, retry_after=clock.now + 900)
+
+    bot.twitter.upload_media = limited
+
+    assert bot.post() == "error"
+
+    assert bot.outbox.limited() == 900
+
+    bot.cursor.execute("SELECT NEXT FROM test_OUTBOX")
+    assert bot.cursor.fetchone()[0] == clock.now + 900
+
+    #Nothing is tried until the limit resets.
+    assert bot.post() == "rate_limited"
+
+    clock.now += 900
+
+    assert bot.outbox.limited() == 0
+
+    del bot.twitter.upload_media
+
+    assert bot.post() == "ok"
+
+#Admins are sent at most one digest of errors every "digest_interval" seconds.
+def test_digest(tmp_path, clock):
+
+    bot = make_bot(tmp_path, clock, dm_errors=True, admin_ids=["1"], digest_interval=3600)
+
+    bot.twitter.failing = True
+
+    sent = []
+    bot.twitter.send_direct_message = lambda event=None: sent.append(event["message_create"]["message_data"]["text"])
+
+    assert bot.post() == "error"
+    assert bot.post() == "error"
+
+    assert len(sent) == 1
+    assert "ConnectionError x1: Twitter is down" in sent[0]
+
+    #By now the first post is due, so it is retried, and fails again.
+    clock.now += 3600
+
+    assert bot.post() == "error"
+
+    assert len(sent) == 2
+    assert "ConnectionError x2" in sent[1]
+    assert "2 post(s) waiting to be retried." in sent[1]
@@ -0,0 +1,43 @@
+import os
+
+from PIL import Image
+
+from OpenMediaBot.preprocess import prepare
+
+def image(path, size):
+
+    Image.new("RGB", size, (200, 30, 90)).save(path, format="BMP")
+
+    return path
+
+def test_within_limits(tmp_path):
+
+    source = str(tmp_path / "small.png")
+    Image.new("RGB", (16, 16)).save(source, format="PNG")
+
+    assert prepare(source, str(tmp_path / "derivatives")) is None
+
+def test_derivative(tmp_path):
+
+    source = image(str(tmp_path / "large.bmp"), (300, 200))
+
+    path = prepare(source, str(tmp_path / "derivatives"), max_dimension=100)
+
+    with Image.open(path) as im:
+        assert max(im.size) <= 100
+
+    #The derivative is only made once.
+    assert prepare(source, str(tmp_path / "derivatives"), max_dimension=100) == path
+    assert len(os.listdir(tmp_path / "derivatives")) == 1
+
+#Lowering the limits makes a new derivative, rather than reusing one that is now too large.
+def test_limits_lowered(tmp_path):
+
+    source = image(str(tmp_path / "large.bmp"), (300, 200))
+
+    prepare(source, str(tmp_path / "derivatives"), max_dimension=100)
+
+    path = prepare(source, str(tmp_path / "derivatives"), max_dimension=50)
+
+    with Image.open(path) as im:
+        assert max(im.size) <= 50
@@ -0,0 +1,114 @@
+import pytest
+
+from OpenMediaBot.processing import ProcessingTracker, ProcessingError
+
+#These tests drive a ProcessingTracker with a fake status endpoint and a fake clock, so no time actually passes.
+
+def response(state, progress=None, check_after=None, **info):
+
+    info["state"] = state
+
+    if progress is not None:
+        info["progress_percent"] = progress
+
+    if check_after is not None:
+        info["check_after_secs"] = check_after
+
+    return {"media_id":1, "processing_info":info}
+
+#This class stands in for the server. Each status check returns the next of its responses, repeating the last one forever.
+#Sleeping records the delay and moves its clock forward.
+class FakeServer:
+
+    def __init__(self, *responses):
+
+        self.responses = list(responses)
+
+        self.checks = 0
+        self.sleeps = []
+        self.now = 0
+
+    def status(self, media_id):
+
+        self.checks += 1
+
+        return self.responses[min(self.checks, len(self.responses)) - 1]
+
+    def sleep(self, delay):
+
+        self.sleeps.append(delay)
+        self.now += delay
+
+    def clock(self):
+        return self.now
+
+    def tracker(self, first, **settings):
+        return ProcessingTracker(self.status, 1, first, sleep=self.sleep, clock=self.clock, **settings)
+
+def test_no_processing():
+
+    server = FakeServer()
+
+    assert server.tracker({"media_id":1}).wait() == {"media_id":1}
+    assert server.checks == 0
+    assert server.sleeps == []
+
+def test_succeeded():
+
+    done = response("succeeded", 100)
+
+    server = FakeServer(response("in_progress", 40, 3), response("in_progress", 80, 1), done)
+
+    assert server.tracker(response("pending", 0, 5)).wait() is done
+    assert server.checks == 3
+
+    #Each wait is as long as the server asked for, or the initial delay if that is longer.
+    assert server.sleeps == [5, 3, 1]
+
+def test_failed():
+
+    server = FakeServer(response("in_progress", 20), response("failed", 20, error={"name":"InvalidMedia", "message":"Unsupported video format"}))
+
+    with pytest.raises(ProcessingError, match="Unsupported video format"):
+        server.tracker(response("pending")).wait()
+
+    assert server.checks == 2
+
+#A server that never finishes is given up on after the timeout, with the tracker backing off while no progress is made.
+def test_timeout():
+
+    server = FakeServer(response("in_progress", 10))
+
+    with pytest.raises(ProcessingError, match="did not finish within 60 seconds"):
+        server.tracker(response("pending", 10), initial_delay=1, max_delay=16, timeout=60).wait()
+
+    assert server.sleeps == [1, 2, 4, 8, 16, 16, 16]
+
+#The backoff starts over as soon as progress is made again.
+def test_backoff_resets():
+
+    server = FakeServer(response("in_progress", 10), response("in_progress", 10), response("in_progress", 50), response("succeeded", 100))
+
+    server.tracker(response("pending", 10)).wait()
+
+    assert server.sleeps == [1, 2, 4, 1]
+
+def test_start():
+
+    done = []
+
+    server = FakeServer(response("in_progress", 50), response("succeeded", 100))
+
+    future = server.tracker(response("pending", 0)).start(callback=done.append)
+
+    assert future.result(timeout=10) == response("succeeded", 100)
+    assert done == [future]
+
+def test_start_failed():
+
+    server = FakeServer(response("failed", 0))
+
+    future = server.tracker(response("pending", 0)).start()
+
+    with pytest.raises(ProcessingError):
+        future.result(timeout=10)
@@ -0,0 +1,93 @@
+import json
+
+import time
+
+import logging
+
+import threading
+
+import concurrent.futures
+
+from OpenMediaBot.bot import Bot
+
+from OpenMediaBot.scheduler import Scheduler
+
+#This bot's action takes a while, and stops the scheduler once it has run "runs" times.
+class SlowBot(Bot):
+
+    def slow(self):
+
+        time.sleep(self.duration)
+
+        self.done += 1
+
+        if self.done == self.runs:
+            self.scheduler.stop()
+
+def add(scheduler, tmp_path, name, **kwargs):
+
+    bot = scheduler.add(SlowBot, action="slow", name=name, db=str(tmp_path / "media.db"), staging_dir=str(tmp_path / "staging"), scheduler=scheduler, done=0, **kwargs)
+
+    bot.logger.setLevel(logging.WARNING)
+
+    return bot
+
+def run(scheduler, timeout=10):
+
+    thread = threading.Thread(target=scheduler.run)
+    thread.start()
+    thread.join(timeout)
+
+    assert not thread.is_alive()
+
+#A bot that runs longer than its interval is due again the whole time it is running, but the scheduler should still sleep until it finishes.
+def test_overrunning_job(tmp_path, monkeypatch):
+
+    waits = []
+
+    def counted(*args, **kwargs):
+        waits.append(kwargs.get("timeout"))
+        return wait(*args, **kwargs)
+
+    wait = concurrent.futures.wait
+    monkeypatch.setattr(concurrent.futures, "wait", counted)
+
+    scheduler = Scheduler()
+
+    bot = add(scheduler, tmp_path, "slow", interval=0.05, duration=1.5, runs=1)
+
+    run(scheduler)
+
+    assert bot.done == 1
+
+    #Waiting a second at a time, there should only be a couple of waits, rather than thousands.
+    assert len(waits) <= 4
+    assert all(timeout > 0 for timeout in waits)
+
+def test_intervals(tmp_path):
+
+    scheduler = Scheduler()
+
+    fast = add(scheduler, tmp_path, "fast", interval=0.1, duration=0, runs=3)
+    slow = add(scheduler, tmp_path, "slow", interval=60, duration=0, runs=None)
+
+    run(scheduler)
+
+    assert fast.done == 3
+    assert slow.done == 1
+
+#A bot's database file can be set in its configuration file, rather than passed to the scheduler.
+def test_configfile_db(tmp_path):
+
+    configfile = tmp_path / "bot.json"
+    configfile.write_text(json.dumps({"name":"configured", "db":str(tmp_path / "other.db"), "staging_dir":str(tmp_path / "staging"), "duration":0, "runs":1, "done":0}))
+
+    scheduler = Scheduler()
+
+    bot = scheduler.add(SlowBot, action="slow", configfile=str(configfile), scheduler=scheduler)
+    bot.logger.setLevel(logging.WARNING)
+
+    run(scheduler)
+
+    assert bot.done == 1
+    assert list(scheduler.pool.idle) == [str(tmp_path / "other.db")]
@@ -0,0 +1,194 @@
+import random
+
+import logging
+
+from collections import Counter
+
+import pytest
+
+from OpenMediaBot.bot import Bot
+
+from OpenMediaBot.selection import WeightedSet
+
+from benchmarks.fakes import FakeDrive
+
+def test_pick_frequencies():
+
+    rng = random.Random(1)
+
+    weights = WeightedSet([("a", 1), ("b", 3), ("c", 0), ("d", 4)])
+
+    picks = Counter(weights.pick(rng) for i in range(40000))
+
+    assert "c" not in picks
+    assert picks["a"] / 40000 == pytest.approx(0.125, abs=0.01)
+    assert picks["b"] / 40000 == pytest.approx(0.375, abs=0.01)
+    assert picks["d"] / 40000 == pytest.approx(0.5, abs=0.01)
+
+def test_nothing_to_pick():
+
+    with pytest.raises(IndexError):
+        WeightedSet().pick()
+
+    with pytest.raises(IndexError):
+        WeightedSet([("a", 0)]).pick()
+
+#Adding keys to an empty set grows its tree, and the weights still add up.
+def test_growth():
+
+    weights = WeightedSet()
+
+    for i in range(100):
+        weights.set(i, i)
+
+    assert weights.capacity >= 100
+    assert weights.total == sum(range(100))
+    assert weights.positive == 99
+
+def test_discard_and_reuse():
+
+    rng = random.Random(2)
+
+    weights = WeightedSet((i, 1) for i in range(10))
+
+    for i in range(5):
+        weights.discard(i)
+
+    #Discarding a key that isn't there does nothing.
+    weights.discard(0)
+
+    assert len(weights) == 5
+    assert weights.total == 5
+    assert all(weights.pick(rng) >= 5 for i in range(1000))
+
+    #New keys take the slots of the keys that were discarded, rather than growing the set.
+    for i in range(10, 15):
+        weights.set(i, 2)
+
+    assert len(weights.keys) == 10
+    assert weights.total == 15
+    assert 0 not in weights and weights.weight(0) == 0
+
+    picks = Counter(weights.pick(rng) for i in range(30000))
+
+    assert set(picks) == set(range(5, 15))
+    assert picks[12] / 30000 == pytest.approx(2 / 15, abs=0.01)
+
+#Random changes always agree with a dictionary of the same weights.
+def test_against_dict():
+
+    rng = random.Random(3)
+
+    weights = WeightedSet()
+    reference = {}
+
+    for i in range(5000):
+
+        key = rng.randrange(200)
+
+        if rng.random() < 0.3:
+            weights.discard(key)
+            reference.pop(key, None)
+
+        else:
+            weight = rng.choice((0, rng.random() * 10))
+            weights.set(key, weight)
+            reference[key] = weight
+
+        if i % 100 == 0:
+
+            assert len(weights) == len(reference)
+            assert weights.total == pytest.approx(sum(reference.values()))
+            assert weights.positive == sum(weight > 0 for weight in reference.values())
+
+            if weights.positive:
+                assert reference[weights.pick(rng)] > 0
+
+def make_bot(tmp_path, drive, folders, **settings):
+
+    bot = Bot(name="test", db=str(tmp_path / "media.db"), staging_dir=str(tmp_path / "staging"), drive_folders=folders, drive_client=drive, **settings)
+    bot.logger.setLevel(logging.WARNING)
+
+    return bot
+
+def picks(bot, count):
+    return Counter(bot._select()[0] for i in range(count))
+
+@pytest.fixture
+def drive():
+
+    drive = FakeDrive()
+
+    drive.populate("A", 1)
+    drive.populate("B", 9)
+    drive.populate("C", 5)
+
+    return drive
+
+#Each folder is picked as often as the others, however many files are in it, and a folder with a weight of 0 is never picked.
+def test_folder_weighted(tmp_path, drive):
+
+    random.seed(4)
+
+    bot = make_bot(tmp_path, drive, ["A", "B", "C"], selection="folder", selection_options={"weights":{"C":0}})
+    bot.updatedb()
+
+    assert bot._count("WHERE POSTED=FALSE AND GRP IS NULL", (), True) == 10
+
+    folders = Counter(id.split("-")[0] for id in picks(bot, 4000).elements())
+
+    assert "C" not in folders
+    assert folders["A"] / 4000 == pytest.approx(0.5, abs=0.03)
+
+#Once every file in the folders that can be picked has been posted, the database is reset rather than picking from the folder with a weight of 0.
+def test_folder_weighted_all_posted(tmp_path, drive):
+
+    bot = make_bot(tmp_path, drive, ["A", "B", "C"], selection="folder", selection_options={"weights":{"B":0, "C":0}})
+    bot.updatedb()
+
+    with bot.connection:
+        bot._posted(["A-0000000"])
+
+    assert bot._select()[0] == "A-0000000"
+
+#Files that are changed through the bot are updated in place, without reading every file again.
+def test_changes(tmp_path, drive):
+
+    bot = make_bot(tmp_path, drive, ["A", "B"], selection="uniform")
+    bot.updatedb()
+
+    bot._select()
+
+    sampler = bot.selector.samplers[True]
+
+    bot.prioritize(["B-0000000"], 0)
+
+    with bot.connection:
+        bot._posted(["B-0000001"])
+
+    picked = picks(bot, 2000)
+
+    assert bot.selector.samplers[True] is sampler
+    assert "B-0000000" not in picked and "B-0000001" not in picked
+    assert len(picked) == 8
+
+#If another process changes the database, the files are read again.
+def test_revision_changed(tmp_path, drive):
+
+    bot = make_bot(tmp_path, drive, ["A", "B"], selection="uniform")
+    bot.updatedb()
+
+    bot._select()
+
+    sampler = bot.selector.samplers[True]
+
+    other = make_bot(tmp_path, drive, ["A", "B"], selection="uniform")
+
+    with other.connection:
+        other._posted(["A-0000000", "B-0000000"])
+
+    picked = picks(bot, 2000)
+
+    assert bot.selector.samplers[True] is not sampler
+    assert "A-0000000" not in picked and "B-0000000" not in picked
+    assert len(picked) == 8
@@ -0,0 +1,188 @@
+import os
+
+import logging
+
+import pytest
+
+from OpenMediaBot.bot import Bot
+
+from benchmarks.fakes import FakeDrive
+
+#These tests sync a bot against the fake Drive from the benchmarks, and check the changes it reports and the rows it leaves in its database.
+
+def make_bot(tmp_path, **settings):
+
+    bot = Bot(name="test", db=str(tmp_path / "media.db"), staging_dir=str(tmp_path / "staging"), **settings)
+
+    bot.logger.setLevel(logging.WARNING)
+
+    return bot
+
+#This function returns every file in the bot's database, from its ID to its name and folder.
+def rows(bot):
+
+    bot.cursor.execute("SELECT ID, NAME, FOLDER FROM '{}'".format(bot.name))
+
+    return {row[0]:row[1:] for row in bot.cursor.fetchall()}
+
+def changes(added=0, renamed=0, modified=0, deleted=0):
+    return {"added":added, "renamed":renamed, "modified":modified, "deleted":deleted}
+
+@pytest.fixture
+def drive():
+
+    drive = FakeDrive()
+
+    drive.populate("A", 3)
+    drive.populate("B", 2)
+    drive.populate("elsewhere", 1)
+
+    return drive
+
+@pytest.fixture
+def bot(tmp_path, drive):
+
+    bot = make_bot(tmp_path, drive_folders=["A", "B"], drive_client=drive, incremental_sync=True)
+
+    assert bot.updatedb() == changes(added=5)
+
+    return bot
+
+def test_full_sync(bot):
+
+    assert rows(bot) == {"A-0000000":("A-0000000.png", "A"), "A-0000001":("A-0000001.png", "A"), "A-0000002":("A-0000002.png", "A"),
+                         "B-0000000":("B-0000000.png", "B"), "B-0000001":("B-0000001.png", "B")}
+
+def test_nothing_changed(bot, drive):
+
+    assert bot.updatedb() == changes()
+
+    #The second sync only fetches changes, rather than listing every folder again.
+    assert drive.calls["list_changes"] == 1
+    assert drive.calls["list_pages"] == 2
+
+def test_add(bot, drive):
+
+    drive.put("new", "new.png", "B")
+    drive.put("ignored", "ignored.png", "elsewhere")
+
+    assert bot.updatedb() == changes(added=1)
+    assert rows(bot)["new"] == ("new.png", "B")
+    assert "ignored" not in rows(bot)
+
+def test_rename(bot, drive):
+
+    drive.rename("A-0000001", "renamed.png")
+
+    assert bot.updatedb() == changes(renamed=1)
+    assert rows(bot)["A-0000001"] == ("renamed.png", "A")
+
+def test_modify(bot, drive):
+
+    drive.put("A-0000001", "A-0000001.png", "A")
+
+    assert bot.updatedb() == changes(modified=1)
+
+def test_trash(bot, drive):
+
+    drive.trash("A-0000001")
+
+    assert bot.updatedb() == changes(deleted=1)
+    assert "A-0000001" not in rows(bot)
+
+def test_delete(bot, drive):
+
+    drive.delete("B-0000000")
+
+    assert bot.updatedb() == changes(deleted=1)
+    assert "B-0000000" not in rows(bot)
+
+def test_move(bot, drive):
+
+    #Between two of our folders, out of them, and into them.
+    drive.move("A-0000000", "B")
+    drive.move("A-0000001", "elsewhere")
+    drive.move("elsewhere-0000000", "A")
+
+    assert bot.updatedb() == changes(added=1, deleted=1)
+
+    assert rows(bot)["A-0000000"] == ("A-0000000.png", "B")
+    assert "A-0000001" not in rows(bot)
+    assert rows(bot)["elsewhere-0000000"] == ("elsewhere-0000000.png", "A")
+
+#The same file changing more than once between syncs is only applied once, as it is last seen.
+def test_changed_twice(bot, drive):
+
+    drive.rename("A-0000002", "renamed.png")
+    drive.trash("A-0000002")
+
+    assert bot.updatedb() == changes(deleted=1)
+
+def test_invalid_token(bot, drive):
+
+    with bot.connection:
+        bot._setstate("drive_token", "bogus")
+
+    drive.delete("A-0000000")
+    drive.put("new", "new.png", "A")
+
+    #The bot falls back to listing every folder, which finds the changes all the same.
+    assert bot.updatedb() == changes(added=1, deleted=1)
+    assert drive.calls["list_pages"] == 4
+
+    #A new token is saved, so the next sync is incremental again.
+    assert bot._getstate("drive_token") == str(len(drive.changes))
+
+    assert bot.updatedb() == changes()
+    assert drive.calls["list_pages"] == 4
+
+#A token is only valid for the folders it was created with, so changing them means listing every folder again.
+def test_folders_changed(tmp_path, bot, drive):
+
+    bot.connection.close()
+
+    bot = make_bot(tmp_path, drive_folders=["A"], drive_client=drive, incremental_sync=True)
+
+    assert bot.updatedb() == changes(deleted=2)
+    assert drive.calls["list_pages"] == 3
+
+def local_file(path, data=b"data"):
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    with open(path, "wb") as file:
+        file.write(data)
+
+def test_local_delete(tmp_path):
+
+    library = str(tmp_path / "library")
+
+    local_file(os.path.join(library, "one.png"))
+    local_file(os.path.join(library, "sub", "two.png"))
+
+    bot = make_bot(tmp_path, local_folders=[library])
+
+    assert bot.updatedb() == changes(added=2)
+
+    os.remove(os.path.join(library, "sub", "two.png"))
+
+    assert bot.updatedb() == changes(deleted=1)
+    assert [row[0] for row in rows(bot).values()] == ["one.png"]
+
+#A local folder that is missing altogether is more likely to be an unmounted drive than a deleted library, so nothing is deleted.
+def test_local_missing(tmp_path):
+
+    library = str(tmp_path / "library")
+
+    local_file(os.path.join(library, "one.png"))
+
+    bot = make_bot(tmp_path, local_folders=[library])
+
+    bot.updatedb()
+
+    os.rename(library, library + ".moved")
+
+    with pytest.raises(FileNotFoundError):
+        bot.updatedb()
+
+    assert len(rows(bot)) == 1